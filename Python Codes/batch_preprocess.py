@@ -0,0 +1,190 @@
+"""
+Batch preprocessing of whole imaging sessions.
+
+Runs the extract -> df/f0 -> bandpass -> correction chain of video_processing for
+every mouse of one or more sessions on a single joblib process pool. Each
+(mouse, channel) pair is one task and each mouse's correction is another, so the
+pool is started once and its workers are reused between steps.
+
+Usage:
+    python batch_preprocess.py <session directory or .raw file> [...] [--n-jobs N]
+"""
+
+import argparse
+import glob
+import os
+
+from joblib import cpu_count, delayed, Parallel
+
+import video_processing as vp
+
+
+def find_raw_files(paths):
+    """
+    Expand session directories into the .RAW imaging files they contain
+
+    :param paths: session directories and/or paths to .RAW files
+    :type: str or list of str
+
+    :return: paths to .RAW imaging files, sorted within each session
+    :type: list
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    raw_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            raw_files.extend(
+                f
+                for f in sorted(glob.glob(os.path.join(path, "*.raw")))
+                if "timestamp" not in os.path.basename(f).lower()
+            )
+        elif os.path.isfile(path):
+            raw_files.append(path)
+        else:
+            raise FileNotFoundError(f"{path} does not exist")
+    return raw_files
+
+
+def derivative_paths(raw_file, low_freq_cutoff, high_freq_cutoff, output_dir=None):
+    """
+    Names of the files written for one .RAW file
+
+    :param raw_file: path to .RAW imaging file
+    :type: str
+    :param low_freq_cutoff: first critical frequency of the bandpass filter
+    :type: float
+    :param high_freq_cutoff: second critical frequency of the bandpass filter
+    :type: float
+    :param output_dir: directory for the results; default is a 'Derivatives'
+    folder next to raw_file
+    :type: str
+
+    :return: paths of the filtered green, filtered blue and corrected frames
+    :type: tuple of str
+    """
+    if output_dir is None:
+        output_dir = os.path.join(os.path.dirname(raw_file), "Derivatives")
+    stem = os.path.splitext(os.path.basename(raw_file))[0]
+    band = f"{low_freq_cutoff}-{high_freq_cutoff}Hz"
+    return (
+        os.path.join(output_dir, f"{stem}_GREEN_{band}.raw"),
+        os.path.join(output_dir, f"{stem}_BLUE_{band}.raw"),
+        os.path.join(output_dir, f"{stem}_corrected_{band}.raw"),
+    )
+
+
+def preprocess_sessions(
+    paths,
+    width=256,
+    height=256,
+    low_freq_cutoff=0.01,
+    high_freq_cutoff=12.0,
+    frame_rate=30,
+    output_dir=None,
+    n_jobs=None,
+    block_size=512,
+    verbose=0,
+):
+    """
+    Preprocess every mouse of the given sessions on one process pool
+
+    :param paths: session directories and/or paths to .RAW files
+    :type: str or list of str
+    :param width: width of data
+    :type: int
+    :param height: height of data
+    :type: int
+    :param low_freq_cutoff: first critical frequency of the bandpass filter
+    :type: float>0
+    :param high_freq_cutoff: second critical frequency of the bandpass filter
+    :type: float>0
+    :param frame_rate: frame rate of the footage
+    :type: float>0
+    :param output_dir: directory for the results; default is a 'Derivatives'
+    folder in each session
+    :type: str
+    :param n_jobs: number of worker processes; default is the number of CPUs
+    :type: None or int>0
+    :param block_size: number of frames processed at a time by each worker
+    :type: int>0
+    :param verbose: joblib verbosity level
+    :type: int
+
+    :return: mapping of each .RAW file to the path of its corrected frames
+    :type: dict
+    """
+    raw_files = find_raw_files(paths)
+    if n_jobs is None:
+        n_jobs = cpu_count()
+    filt = vp.Filter(
+        low_freq_cutoff=low_freq_cutoff,
+        high_freq_cutoff=high_freq_cutoff,
+        frame_rate=frame_rate,
+    )
+    outputs = {
+        raw_file: derivative_paths(
+            raw_file, low_freq_cutoff, high_freq_cutoff, output_dir
+        )
+        for raw_file in raw_files
+    }
+    for green, _, _ in outputs.values():
+        os.makedirs(os.path.dirname(green), exist_ok=True)
+
+    with Parallel(n_jobs=n_jobs, verbose=verbose) as parallel:
+        # One task per mouse and channel
+        parallel(
+            delayed(vp.filter_RAW_channel_stream)(
+                raw_file, output, width, height, filt, channel,
+                block_size=block_size,
+            )
+            for raw_file, (green, blue, _) in outputs.items()
+            for channel, output in (("green", green), ("blue", blue))
+        )
+        # One task per mouse, on the same workers
+        parallel(
+            delayed(vp.correct_RAW_stream)(
+                green, blue, corrected, width, height, block_size=block_size
+            )
+            for green, blue, corrected in outputs.values()
+        )
+    return {
+        raw_file: corrected for raw_file, (_, _, corrected) in outputs.items()
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Preprocess all mice of one or more imaging sessions"
+    )
+    parser.add_argument(
+        "paths", nargs="+", help="session directories and/or .raw files"
+    )
+    parser.add_argument("--width", type=int, default=256)
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--low", type=float, default=0.01, help="low cutoff (Hz)")
+    parser.add_argument("--high", type=float, default=12.0, help="high cutoff (Hz)")
+    parser.add_argument("--frame-rate", type=float, default=30)
+    parser.add_argument("--output-dir", default=None)
+    parser.add_argument("--n-jobs", type=int, default=None)
+    parser.add_argument("--block-size", type=int, default=512)
+    args = parser.parse_args(argv)
+
+    corrected = preprocess_sessions(
+        args.paths,
+        width=args.width,
+        height=args.height,
+        low_freq_cutoff=args.low,
+        high_freq_cutoff=args.high,
+        frame_rate=args.frame_rate,
+        output_dir=args.output_dir,
+        n_jobs=args.n_jobs,
+        block_size=args.block_size,
+        verbose=5,
+    )
+    for raw_file, output in corrected.items():
+        print(f"{raw_file} -> {output}")
+
+
+if __name__ == "__main__":
+    main()
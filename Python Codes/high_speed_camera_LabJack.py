@@ -1,189 +1,1267 @@
-import os
-
-#import board
-#import digitalio
-#import tempfile
-from datetime import datetime
-import stapipy as st
-import time
-import numpy as np
-import u3 # This is using LabJack on laptop to do sync!
-import io
-import pandas as pd
-from pathlib import Path
-#import cv2
-
-#Device:LabJack U3
-d = u3.U3()
-
-#trigger pin is connected to raspberry pi
-#trigger_pin = digitalio.DigitalInOut(board.C0)
-#trigger_pin.direction = digitalio.Direction.INPUT
-
-#camera_pin = digitalio.DigitalInOut(board.C1)
-#camera_pin.direction = digitalio.Direction.INPUT
-
-
-
-# Number of images to grab
-duration = 200
-fps = 300
-number_of_images_to_grab = round(duration * fps)
-
-# Path to save the video
-savepath = r"C:\Users\Haozong\OneDrive\Dual Brain\Whisker"
-
-# Maximum number of frames in one video file
-maximum_frame_count_per_file = 100_000
-
-# Number of video files
-video_files_count = 1
-
-# Timestamps and frame number streams
-s_timestamp = io.StringIO()
-s_frame_n = io.StringIO()
-
-
-def videofiler_callback(handle=None, context=None):
-    """
-    Callback to handle events from Video Filer.
-
-    :param handle: handle that trigger the callback.
-    :param context: user data passed on during callback registration.
-    """
-    callback_type = handle.callback_type
-    videofiler = handle.module
-    if callback_type == st.EStCallbackType.StApiIPVideoFilerOpen:
-        print("Open:", handle.data['filename'])
-    elif callback_type == st.EStCallbackType.StApiIPVideoFilerClose:
-        print("Close:", handle.data['filename'])
-    elif callback_type == st.EStCallbackType.StApiIPVideoFilerError:
-        print("Error:", handle.error[1])
-        context['error'] = True
-
-
-if __name__ == "__main__":
-    try:
-        
-        # Initialize StApi before using.
-        st.initialize()
-        
-        # Create a system object for device scan and connection.
-        st_system = st.create_system()
-
-        # Connect to first detected device.
-        st_device = st_system.create_first_device()
-
-        # Display DisplayName of the device.
-        print('Device=', st_device.info.display_name)
-
-        # Get the acquisition fps of the camera.
-        acquisition_frame_rate = st_device.remote_port.nodemap.get_node(
-            "AcquisitionFrameRate")        
-        acquisition_frame_rate.value = fps
-
-        # Create PyStVideoFiler
-        st_videofiler = st.create_filer(st.EStFilerType.Video)
-
-        # Register a callback function.
-        callback_info = {'error': False}
-        videofiler_cb = st_videofiler.register_callback(videofiler_callback,
-                                                        callback_info)
-
-        # Configure the video file settings.
-        st_videofiler.maximum_frame_count_per_file = \
-            maximum_frame_count_per_file
-        st_videofiler.video_file_format = st.EStVideoFileFormat.AVI1
-        st_videofiler.video_file_compression = \
-            st.EStVideoFileCompression.MotionJPEG
-        st_videofiler.fps = fps
-
-        # Register video files
-        sep = "-"
-        date = datetime.today().strftime('%Y%m%d')
-        filename = sep.join((date, "whisker"))
-        st_videofiler.register_filename(savepath + "/" + filename + ".avi")
-
-        # Create a datastream object for handling image stream data.
-        st_datastream = st_device.create_datastream()
-
-        #print("Trigger received. Waiting for record")
-        #while not camera_pin.value:
-        #    pass
-
-        print("waiting for trigger")
-        while d.getDIState(ioNum=0):
-            pass
-        # Start the image acquisition of the host (local machine) side.
-        st_datastream.start_acquisition(number_of_images_to_grab)
-
-        # Start the image acquisition of the camera side.
-        st_device.acquisition_start()
-
-        first_frame = True
-        first_timestamp = 0
-        framesize = 720*540
-        print(number_of_images_to_grab * framesize * 8)
-        frame_number = 0
-        while st_datastream.is_grabbing:
-
-            if callback_info['error']:
-                break
-            with st_datastream.retrieve_buffer() as st_buffer:
-                # Check if the acquired data contains image data.
-                if st_buffer.info.is_image_present:
-                    # Create an image object.
-                    st_image = st_buffer.get_image()
-                    
-                    # Display the information of the acquired image data.
-                    print("BlockID={0} Size={1} x {2} {3:.2f} fps".format(
-                          st_buffer.info.frame_id,
-                          st_image.width, st_image.height,
-                          st_datastream.current_fps))
-
-                    # Calculate frame number in case of frame drop.
-                    frame_no = 0
-                    current_timestamp = st_buffer.info.timestamp
-                    if first_frame:
-                        first_frame = False
-                        delta = 0
-                        first_timestamp = current_timestamp
-                    else:
-                        delta = current_timestamp - first_timestamp
-                        tmp = delta * fps / 1000000000.0
-                        frame_no = int(tmp + 0.5)
-
-                    # Add the image data to video file.
-                    st_videofiler.register_image(st_image, frame_no)
-                    
-                    # Add the timestamp and frame number to stream
-                    s_timestamp.write(str(delta / 1000000000.0) + ' ')
-                    s_frame_n.write(str(frame_number)+ ' ')
-                    frame_number += 1
-                else:
-                    # If the acquired data contains no image data.
-                    print("Image data does not exist.")
-
-
-        # Stop the image acquisition of the camera side
-        st_device.acquisition_stop()
-
-        # Stop the image acquisition of the host side
-        st_datastream.stop_acquisition()
-        
-        # Save the timestamps and frame numbers
-        timestamps = s_timestamp.getvalue()
-        timestamps = timestamps.split()
-        frames = s_frame_n.getvalue()
-        frames = frames.split()
-        df = pd.DataFrame({'frame number':frames, 'timestamp':timestamps})
-        df['timestamp'] = df['timestamp'].astype(float) + float(df['timestamp'][2])
-        df.iloc[0, 1] = 0
-        file_path = Path(savepath + '/' + sep.join((date, "whisker-timestamp.csv")))  
-        file_path.parent.mkdir(parents=True, exist_ok=True)
-        df.to_csv(file_path)
-        print('done')
-    except Exception as exception:
-        print(exception)
-
-
+import json
+import os
+
+#import board
+#import digitalio
+#import tempfile
+from datetime import datetime
+import threading
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import cv2
+
+# stapipy (camera SDK) and u3 (LabJack) are imported where they are used, so that the
+# capture pipeline can be driven by SimulatedCamera on a machine without them
+
+#trigger pin is connected to raspberry pi
+#trigger_pin = digitalio.DigitalInOut(board.C0)
+#trigger_pin.direction = digitalio.Direction.INPUT
+
+#camera_pin = digitalio.DigitalInOut(board.C1)
+#camera_pin.direction = digitalio.Direction.INPUT
+
+
+
+# Number of images to grab
+duration = 200
+fps = 300
+number_of_images_to_grab = round(duration * fps)
+
+# Path to save the video
+savepath = r"C:\Users\Haozong\OneDrive\Dual Brain\Whisker"
+
+# Name of each camera, in the order the devices are detected; each camera records
+# <date>-<name>.avi
+camera_names = ("whisker", "limb")
+
+# Maximum number of frames in one video file; the video rolls over to a new segment file
+# after this many frames, see SegmentedVideoWriter
+maximum_frame_count_per_file = 100_000
+
+# Number of video files
+video_files_count = 1
+
+# Number of frames the ring buffer between the grab thread and the writer can hold
+ring_capacity = 512
+
+# Seconds between two status lines
+status_interval = 1.0
+
+# Number of frames between two flushes of the timestamp log to disk
+log_flush_every = 300
+
+# Digital input of the LabJack receiving the start trigger, and its level once triggered
+trigger_io = 0
+trigger_level = 0
+
+# Seconds between two reads of the trigger input; the thread sleeps in between
+trigger_poll_interval = 0.0005
+
+# If True, the trigger input is sampled by the LabJack in stream mode at trigger_scan_frequency Hz
+# and the edge is timed from its sample index instead of polling
+trigger_stream = False
+trigger_scan_frequency = 10000
+
+# One record of the timestamp log: frame id and timestamp from the camera, time the
+# frame reached the host (time.perf_counter_ns) and state of the trigger input
+timestamp_dtype = np.dtype([
+    ("frame_id", "<i8"),
+    ("device_ns", "<i8"),
+    ("host_ns", "<i8"),
+    ("trigger", "u1"),
+    # Last position of the frame in the video (see VideoClock), and 0 if the frame was dropped
+    # from the ring buffer and never reached the video
+    ("video_frame", "<i8"),
+    ("written", "u1"),
+])
+
+
+class LabJackTrigger:
+    """
+    Start trigger on a digital input of a LabJack U3, timed with the host monotonic clock
+    (time.perf_counter_ns). In polling mode the input is read every poll_interval seconds and the
+    thread sleeps in between; in stream mode the LabJack samples the input at scan_frequency and
+    the edge is timed from the index of the first triggered sample.
+    """
+
+    def __init__(self, device, io_num=trigger_io, level=trigger_level,
+                 poll_interval=trigger_poll_interval, stream=trigger_stream,
+                 scan_frequency=trigger_scan_frequency):
+        """
+        :param device: u3.U3 or MockLabJack
+        :param io_num: digital input receiving the trigger
+        :type: int
+        :param level: state of the input once triggered
+        :type: int
+        :param poll_interval: seconds between two reads in polling mode
+        :type: float
+        :param stream: use stream mode instead of polling
+        :type: bool
+        :param scan_frequency: sampling frequency in stream mode
+        :type: float
+        """
+        self.device = device
+        self.io_num = io_num
+        self.level = level
+        self.poll_interval = poll_interval
+        self.stream = stream
+        self.scan_frequency = scan_frequency
+        self.edge_ns = None
+        self.uncertainty_ns = None
+        # The logging threads of several cameras read the input through one device
+        self._lock = threading.Lock()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the trigger
+
+        :param timeout: seconds to wait; forever if unspecified
+        :type: float
+
+        :return: estimated time.perf_counter_ns() of the edge
+        :type: int
+        """
+        if self.stream:
+            self._wait_stream(timeout)
+        else:
+            self._wait_poll(timeout)
+        return self.edge_ns
+
+    def state(self):
+        """
+        Current state of the trigger input
+        """
+        with self._lock:
+            return self.device.getDIState(ioNum=self.io_num)
+
+    def metadata(self):
+        """
+        :return: edge time, its uncertainty and the settings of the trigger
+        :type: dict
+        """
+        return {
+            "trigger_edge_ns": self.edge_ns,
+            "trigger_uncertainty_ns": self.uncertainty_ns,
+            "trigger_mode": "stream" if self.stream else "poll",
+            "trigger_poll_interval": self.poll_interval,
+            "trigger_scan_frequency": self.scan_frequency,
+        }
+
+    def _wait_poll(self, timeout):
+        deadline = None if timeout is None else time.perf_counter_ns() + timeout * 1e9
+        previous = time.perf_counter_ns()
+        while True:
+            before = time.perf_counter_ns()
+            triggered = self.device.getDIState(ioNum=self.io_num) == self.level
+            after = time.perf_counter_ns()
+            if triggered:
+                # The edge is between the previous read and this one
+                self.edge_ns = (previous + after) // 2
+                self.uncertainty_ns = (after - previous) // 2
+                return
+            previous = before
+            if deadline is not None and after > deadline:
+                raise TimeoutError("No trigger received")
+            time.sleep(self.poll_interval)
+
+    def _wait_stream(self, timeout):
+        deadline = None if timeout is None else time.perf_counter_ns() + timeout * 1e9
+        # Channel 193 streams the states of the FIO (low byte) and EIO (high byte) lines
+        self.device.streamConfig(NumChannels=1, PChannels=[193], NChannels=[31],
+                                 ScanFrequency=self.scan_frequency)
+        self.device.streamStart()
+        start = time.perf_counter_ns()
+        n_samples = 0
+        try:
+            for packet in self.device.streamData():
+                if packet is None:
+                    continue
+                # Samples lost to a buffer overflow still took time
+                n_samples += packet.get("missed", 0)
+                for sample in packet["AIN193"]:
+                    fio = sample[0] if isinstance(sample, tuple) else sample & 0xFF
+                    if (fio >> self.io_num) & 1 == self.level:
+                        self.edge_ns = start + round(n_samples * 1e9 / self.scan_frequency)
+                        self.uncertainty_ns = round(1e9 / self.scan_frequency)
+                        return
+                    n_samples += 1
+                if deadline is not None and time.perf_counter_ns() > deadline:
+                    raise TimeoutError("No trigger received")
+        finally:
+            self.device.streamStop()
+
+
+class MockLabJack:
+    """
+    Stand-in for a LabJack U3 whose trigger input changes state at a scheduled time, with the
+    USB round-trip of each read simulated by a sleep. Supports getDIState and stream mode.
+    """
+
+    def __init__(self, delay=0.1, usb_latency=0.0005, idle_level=1, packet_size=25):
+        """
+        :param delay: seconds from creation (or schedule) to the edge
+        :type: float
+        :param usb_latency: duration of each read, in seconds
+        :type: float
+        :param idle_level: state of the input before the edge
+        :type: int
+        :param packet_size: number of samples per stream packet
+        :type: int
+        """
+        self.usb_latency = usb_latency
+        self.idle_level = idle_level
+        self.packet_size = packet_size
+        self.reads = 0
+        self.schedule(delay)
+
+    def schedule(self, delay):
+        """
+        Set the edge delay seconds from now
+        """
+        self.edge_ns = time.perf_counter_ns() + round(delay * 1e9)
+
+    def _level(self, t):
+        return self.idle_level if t < self.edge_ns else 1 - self.idle_level
+
+    def getDIState(self, ioNum=0):
+        self.reads += 1
+        # The input is sampled in the middle of the round trip
+        time.sleep(self.usb_latency / 2)
+        level = self._level(time.perf_counter_ns())
+        time.sleep(self.usb_latency / 2)
+        return level
+
+    def streamConfig(self, NumChannels=1, PChannels=(193,), NChannels=(31,), ScanFrequency=10000, **kwargs):
+        self.scan_frequency = ScanFrequency
+
+    def streamStart(self):
+        self._stream_start = time.perf_counter_ns()
+
+    def streamData(self):
+        n_samples = 0
+        while True:
+            n_samples += self.packet_size
+            due = self._stream_start + round(n_samples * 1e9 / self.scan_frequency)
+            time.sleep(max(due - time.perf_counter_ns(), 0) / 1e9)
+            times = self._stream_start + np.round(
+                np.arange(n_samples - self.packet_size, n_samples) * 1e9 / self.scan_frequency)
+            yield {"AIN193": [(self._level(t), 0) for t in times], "missed": 0}
+
+    def streamStop(self):
+        pass
+
+
+def benchmark_trigger(n_trials=20, delay=0.05, **kwargs):
+    """
+    Measure the error and jitter of LabJackTrigger on a MockLabJack
+
+    :param n_trials: number of triggers
+    :type: int
+    :param delay: seconds from arming the trigger to the edge
+    :type: float
+    :param kwargs: arguments of LabJackTrigger, i.e. poll_interval or stream
+    :type: dict
+
+    :return: mean and standard deviation (jitter) of the error of the edge time and of the
+    wake-up latency after the edge, in microseconds, and the number of reads per trial
+    :type: dict
+    """
+    errors = []
+    latencies = []
+    reads = []
+    for _ in range(n_trials):
+        device = MockLabJack(delay=delay)
+        trigger = LabJackTrigger(device, **kwargs)
+        edge_ns = trigger.wait()
+        woke = time.perf_counter_ns()
+        errors.append((edge_ns - device.edge_ns) / 1e3)
+        latencies.append((woke - device.edge_ns) / 1e3)
+        reads.append(device.reads)
+    return {
+        "error_us": float(np.mean(errors)),
+        "jitter_us": float(np.std(errors)),
+        "latency_us": float(np.mean(latencies)),
+        "latency_jitter_us": float(np.std(latencies)),
+        "reads": float(np.mean(reads)),
+    }
+
+
+def pin_thread(cpus):
+    """
+    Restrict the calling thread to the given CPUs on Linux and Windows; ignored elsewhere
+    or if cpus is empty
+
+    :param cpus: indices of the CPUs
+    :type: list of int
+    """
+    if not cpus:
+        return
+    if hasattr(os, "sched_setaffinity"):
+        # On Linux, pid 0 is the calling thread
+        os.sched_setaffinity(0, cpus)
+    elif os.name == "nt":
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetThreadAffinityMask(
+            kernel32.GetCurrentThread(), sum(1 << cpu for cpu in cpus))
+
+
+def schedule_cpus(n_cameras, n_cpus=None):
+    """
+    Assign CPUs to the threads of each camera: each grab thread gets a CPU of its own, the
+    writers share the other CPUs, and the logging threads run on any of these. Without
+    two CPUs per camera the threads are left to the operating system.
+
+    :param n_cameras: number of cameras
+    :type: int
+    :param n_cpus: number of CPUs; os.cpu_count() if unspecified
+    :type: int
+
+    :return: for each camera, the CPUs of its 'grab', 'writer' and 'log' threads
+    :type: list of dict
+    """
+    if n_cpus is None:
+        n_cpus = os.cpu_count() or 1
+    if n_cpus < 2 * n_cameras:
+        return [{} for _ in range(n_cameras)]
+    shared = list(range(n_cameras, n_cpus))
+    return [
+        {"grab": [camera], "writer": shared[camera::n_cameras], "log": shared}
+        for camera in range(n_cameras)
+    ]
+
+
+def write_json(filename, data):
+    """
+    Write data to a JSON file, replacing the previous file atomically
+    """
+    tmp = str(filename) + ".tmp"
+    with open(tmp, "w") as file:
+        json.dump(data, file, indent=1)
+    os.replace(tmp, filename)
+
+
+class Camera:
+    """
+    Interface of the cameras driven by CapturePipeline. Subclasses copy each image into a
+    buffer provided by the pipeline, so that the grab thread does nothing else.
+    """
+
+    width = 0
+    height = 0
+
+    def start(self, n_frames):
+        """
+        Start the acquisition of n_frames images
+        """
+        raise NotImplementedError
+
+    def grab(self, out):
+        """
+        Wait for the next image and copy it into out
+
+        :param out: buffer of shape (height, width)
+        :type: numpy.ndarray
+
+        :return: frame id and device timestamp in ns, or None if the buffer has no image
+        :type: tuple of int
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        """
+        Stop the acquisition
+        """
+        raise NotImplementedError
+
+    @property
+    def is_grabbing(self):
+        raise NotImplementedError
+
+    @property
+    def current_fps(self):
+        return 0.0
+
+
+class StCamera(Camera):
+    """
+    Camera of the StApi SDK (stapipy)
+    """
+
+    def __init__(self, st_device, fps):
+        """
+        :param st_device: device created by st_system.create_first_device()
+        :param fps: acquisition frame rate
+        :type: float
+        """
+        self.st_device = st_device
+        acquisition_frame_rate = st_device.remote_port.nodemap.get_node(
+            "AcquisitionFrameRate")
+        acquisition_frame_rate.value = fps
+        nodemap = st_device.remote_port.nodemap
+        self.width = nodemap.get_node("Width").value
+        self.height = nodemap.get_node("Height").value
+        self.st_datastream = None
+
+    def start(self, n_frames):
+        # Create a datastream object for handling image stream data.
+        self.st_datastream = self.st_device.create_datastream()
+        # Start the image acquisition of the host (local machine) side.
+        self.st_datastream.start_acquisition(n_frames)
+        # Start the image acquisition of the camera side.
+        self.st_device.acquisition_start()
+
+    def grab(self, out):
+        with self.st_datastream.retrieve_buffer() as st_buffer:
+            # Check if the acquired data contains image data.
+            if not st_buffer.info.is_image_present:
+                return None
+            st_image = st_buffer.get_image()
+            out[...] = np.frombuffer(
+                st_image.get_image_buffer(), dtype=np.uint8
+            ).reshape(out.shape)
+            return st_buffer.info.frame_id, st_buffer.info.timestamp
+
+    def stop(self):
+        # Stop the image acquisition of the camera side
+        self.st_device.acquisition_stop()
+        # Stop the image acquisition of the host side
+        self.st_datastream.stop_acquisition()
+
+    @property
+    def is_grabbing(self):
+        return self.st_datastream is not None and self.st_datastream.is_grabbing
+
+    @property
+    def current_fps(self):
+        return self.st_datastream.current_fps
+
+
+class SimulatedCamera(Camera):
+    """
+    Stand-in for a camera that delivers frames at a fixed rate, for running the capture
+    pipeline without hardware. Each image is filled with the frame id modulo 256.
+    """
+
+    def __init__(self, width=720, height=540, fps=300, drop_every=0, jitter=0.0):
+        """
+        :param width: width of the images
+        :type: int
+        :param height: height of the images
+        :type: int
+        :param fps: frame rate
+        :type: float
+        :param drop_every: if > 0, every drop_every-th frame is lost by the device, i.e. its
+        frame id and timestamp are skipped
+        :type: int
+        :param jitter: standard deviation of the delivery time of each frame, in seconds
+        :type: float
+        """
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.drop_every = drop_every
+        self.jitter = jitter
+        self._rng = np.random.default_rng(0)
+        self._n_frames = 0
+        self._frame_id = 0
+        self._start = None
+
+    def start(self, n_frames):
+        self._n_frames = n_frames
+        self._frame_id = 0
+        self._start = time.perf_counter_ns()
+
+    def grab(self, out):
+        if self.drop_every > 0 and (self._frame_id + 1) % self.drop_every == 0:
+            self._frame_id += 1
+        frame_id = self._frame_id
+        self._frame_id += 1
+        timestamp = round(frame_id * 1e9 / self.fps)
+        due = self._start + timestamp + round(self._rng.normal(0, self.jitter) * 1e9)
+        delay = (due - time.perf_counter_ns()) / 1e9
+        if delay > 0:
+            time.sleep(delay)
+        out[...] = frame_id % 256
+        return frame_id, timestamp
+
+    def stop(self):
+        self._n_frames = 0
+
+    @property
+    def is_grabbing(self):
+        return self._frame_id < self._n_frames
+
+    @property
+    def current_fps(self):
+        return self.fps
+
+
+class RingBuffer:
+    """
+    Preallocated ring of frames and timestamps between one producer (the grab thread) and
+    several readers (i.e. the writer and the logger), each with its own read position.
+    A slot is reused once every reader has released it. The producer never waits: when the
+    ring is full the frame is dropped and counted.
+    """
+
+    def __init__(self, capacity, shape, dtype=np.uint8, readers=("writer", "log")):
+        """
+        :param capacity: number of frames the ring can hold
+        :type: int
+        :param shape: shape of one frame
+        :type: tuple
+        :param dtype: data type of the frames
+        :type: numpy.dtype
+        :param readers: names of the readers
+        :type: tuple of str
+        """
+        self.capacity = capacity
+        self.frames = np.empty((capacity,) + tuple(shape), dtype=dtype)
+        self.frame_ids = np.zeros(capacity, dtype=np.int64)
+        self.timestamps = np.zeros(capacity, dtype=np.int64)
+        self.host_times = np.zeros(capacity, dtype=np.int64)
+        self.head = 0
+        self.tails = dict.fromkeys(readers, 0)
+        self.dropped = 0
+        self.high_water = 0
+        self.closed = False
+        self._dropped = []
+        self._condition = threading.Condition()
+
+    @property
+    def occupancy(self):
+        """
+        Number of frames not yet released by every reader
+        """
+        return self.head - min(self.tails.values())
+
+    def reserve(self):
+        """
+        Index of the slot the next frame is written into, or None if the ring is full
+        """
+        if self.occupancy >= self.capacity:
+            return None
+        return self.head % self.capacity
+
+    def commit(self, frame_id, timestamp, host_time):
+        """
+        Publish the frame written into the reserved slot
+        """
+        slot = self.head % self.capacity
+        self.frame_ids[slot] = frame_id
+        self.timestamps[slot] = timestamp
+        self.host_times[slot] = host_time
+        with self._condition:
+            self.head += 1
+            self.high_water = max(self.high_water, self.occupancy)
+            self._condition.notify_all()
+
+    def drop(self, frame_id, timestamp, host_time):
+        """
+        Count a frame that was grabbed while the ring was full, keeping its timestamps
+        """
+        with self._condition:
+            self.dropped += 1
+            self._dropped.append((frame_id, timestamp, host_time))
+
+    def wait(self, reader, timeout=None, dropped=False):
+        """
+        Wait until frames are available to reader
+
+        :param dropped: also take the frames dropped since the last such call
+        :type: bool
+
+        :return: range of the positions available to reader; empty once the ring is closed
+        and drained. With dropped, also the (frame_id, timestamp, host_time) of the dropped
+        frames, taken together with the range so that both cover the same span of time
+        :type: range or tuple
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.head > self.tails[reader] or self.closed, timeout
+            )
+            available = range(self.tails[reader], self.head)
+            if not dropped:
+                return available
+            taken, self._dropped = self._dropped, []
+            return available, taken
+
+    def release(self, reader, count):
+        """
+        Give back the first count frames available to reader
+        """
+        with self._condition:
+            self.tails[reader] += count
+
+    def close(self):
+        """
+        Tell the readers that no frame will be added
+        """
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def stats(self):
+        """
+        :return: frames grabbed, frames dropped because the ring was full, current and
+        highest occupancy
+        :type: dict
+        """
+        return {
+            "grabbed": self.head,
+            "dropped": self.dropped,
+            "occupancy": self.occupancy,
+            "high_water": self.high_water,
+            "capacity": self.capacity,
+        }
+
+
+class VideoClock:
+    """
+    Position of the frames in the video: a frame is placed by its camera timestamp at fps and
+    repeated over the positions of the frames missing before it; a frame that comes early takes
+    the next free position. The writer and the log each keep one, so they agree on the positions.
+    """
+
+    def __init__(self, fps):
+        self.fps = fps
+        self.first_timestamp = None
+        self.next_position = 0
+
+    def nominal(self, timestamp):
+        """
+        :return: position of a frame from its camera timestamp alone
+        :type: int
+        """
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        return int((timestamp - self.first_timestamp) * self.fps / 1000000000.0 + 0.5)
+
+    def advance(self, timestamp):
+        """
+        Place a frame written to the video
+
+        :return: last position of the frame; it fills the positions from the previous one
+        :type: int
+        """
+        position = max(self.nominal(timestamp), self.next_position)
+        self.next_position = position + 1
+        return position
+
+
+class TimestampLog:
+    """
+    Preallocated binary log of the frames of one camera, written while recording:
+    - <basename>.npy, a numpy structured array of timestamp_dtype records (memory-mapped;
+      records not yet written have frame_id -1), one per grabbed frame including the frames
+      dropped from the ring buffer, with the position of each frame in the video
+    - <basename>.raw, float32 microseconds of each logged frame since the reference time, in the
+      convention of the imaging timestamps: element 0 is a placeholder (overwritten by
+      video_processing.clean_raw_timestamps) and the frames start at element 1, so the file can
+      go through clean_raw_timestamps and get_locations_of_dropped_frames
+    Both are flushed every flush_every records, so a crash keeps the data up to the last flush.
+    """
+
+    def __init__(self, basename, capacity, reference_ns=None, flush_every=log_flush_every):
+        """
+        :param basename: path of the log files without extension, i.e. '<date>-whisker-timestamp'
+        :type: str
+        :param capacity: maximum number of records, i.e. the number of frames to grab
+        :type: int
+        :param reference_ns: time.perf_counter_ns() of the start of the session (i.e. the trigger);
+        the time the log is created if unspecified
+        :type: int
+        :param flush_every: number of records between two flushes
+        :type: int
+        """
+        self.basename = str(basename)
+        self.capacity = capacity
+        self.reference_ns = time.perf_counter_ns() if reference_ns is None else reference_ns
+        self.flush_every = flush_every
+        self.records = np.lib.format.open_memmap(
+            self.basename + ".npy", mode="w+", dtype=timestamp_dtype, shape=(capacity,))
+        self.records["frame_id"] = -1
+        self.microseconds = np.memmap(
+            self.basename + ".raw", dtype=np.float32, mode="w+", shape=(capacity + 1,))
+        self.count = 0
+        self.overflow = 0
+        self._unflushed = 0
+        self._offset_ns = None
+
+    def append(self, frame_ids, device_ns, host_ns, trigger=0, video_frames=-1, written=1):
+        """
+        Add records for a batch of frames, in time order
+
+        :param frame_ids: frame ids from the camera
+        :type: numpy.ndarray
+        :param device_ns: camera timestamps in ns
+        :type: numpy.ndarray
+        :param host_ns: time.perf_counter_ns() at which the frames reached the host
+        :type: numpy.ndarray
+        :param trigger: state of the trigger input
+        :type: int or numpy.ndarray
+        :param video_frames: last position of each frame in the video, see VideoClock
+        :type: int or numpy.ndarray
+        :param written: 1 for frames written to the video, 0 for dropped frames
+        :type: int or numpy.ndarray
+        """
+        n = min(len(frame_ids), self.capacity - self.count)
+        self.overflow += len(frame_ids) - n
+        if n == 0:
+            return
+        if self._offset_ns is None:
+            # The camera clock, anchored on the host clock at the first frame
+            self._offset_ns = host_ns[0] - device_ns[0] - self.reference_ns
+        records = self.records[self.count:self.count + n]
+        records["device_ns"] = device_ns[:n]
+        records["host_ns"] = host_ns[:n]
+        records["trigger"] = trigger if np.ndim(trigger) == 0 else trigger[:n]
+        records["video_frame"] = video_frames if np.ndim(video_frames) == 0 else video_frames[:n]
+        records["written"] = written if np.ndim(written) == 0 else written[:n]
+        records["frame_id"] = frame_ids[:n]
+        self.microseconds[1 + self.count:1 + self.count + n] = (
+            (np.asarray(device_ns[:n]) + self._offset_ns) / 1e3)
+        self.count += n
+        self._unflushed += n
+        if self._unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the records to disk
+        """
+        self.records.flush()
+        self.microseconds.flush()
+        self._unflushed = 0
+
+    def close(self):
+        """
+        Flush the records and cut the .raw file after the last one
+        """
+        self.flush()
+        del self.microseconds
+        os.truncate(self.basename + ".raw", (1 + self.count) * 4)
+
+    @staticmethod
+    def load(filename):
+        """
+        Read the records written to a log, i.e. after a crash
+
+        :param filename: path to the .npy log
+        :type: str
+
+        :return: records of timestamp_dtype
+        :type: numpy.ndarray
+        """
+        records = np.load(filename, mmap_mode="r")
+        return np.array(records[records["frame_id"] >= 0])
+
+    @staticmethod
+    def video_records(filename):
+        """
+        Records of the frames shown at each position of the video: a frame repeated over
+        dropped frames appears once per position
+
+        :param filename: path to the .npy log
+        :type: str
+
+        :return: records of timestamp_dtype, one per video frame
+        :type: numpy.ndarray
+        """
+        records = TimestampLog.load(filename)
+        records = records[records["written"] == 1]
+        if len(records) == 0:
+            return records
+        positions = np.arange(records["video_frame"][-1] + 1)
+        return records[np.searchsorted(records["video_frame"], positions)]
+
+    @staticmethod
+    def export_csv(filename, csv_filename):
+        """
+        Write the records of a log as CSV, one row per video frame, with the frame number and
+        the timestamp in seconds since the first frame read by
+        video_processing.load_behaviour_timestamps
+
+        :param filename: path to the .npy log
+        :type: str
+        :param csv_filename: path to the CSV file
+        :type: str
+        """
+        records = TimestampLog.video_records(filename)
+        df = pd.DataFrame({
+            'frame number': np.arange(len(records)),
+            'timestamp': (records["device_ns"] - records["device_ns"][:1]) / 1e9,
+            'frame id': records["frame_id"],
+            'device ns': records["device_ns"],
+            'host ns': records["host_ns"],
+            'trigger': records["trigger"],
+        })
+        file_path = Path(csv_filename)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        df.to_csv(file_path)
+
+
+class SegmentedVideoWriter:
+    """
+    Video written as rolling segments <stem>-000.avi, <stem>-001.avi, ... of at most
+    segment_frames frames, described by the manifest <stem>-manifest.json. The manifest maps each
+    segment to its frame range [start, stop) and the timestamps of its first and last frames,
+    and is rewritten atomically whenever a segment is closed, so after a crash it still lists
+    every complete segment. video_processing.VideoSession reads the segments as one video.
+    """
+
+    def __init__(self, filename, fps, size, fourcc="MJPG",
+                 segment_frames=maximum_frame_count_per_file, is_color=False, log=None):
+        """
+        :param filename: path to the video, i.e. '<date>-whisker.avi'; segments are numbered after it
+        :type: str
+        :param fps: frame rate of the video
+        :type: float
+        :param size: width and height of the frames
+        :type: tuple
+        :param fourcc: four character code of the video codec; Motion JPEG by default
+        :type: str
+        :param segment_frames: maximum number of frames in one segment
+        :type: int
+        :param is_color: True for BGR frames, False for grayscale
+        :type: bool
+        :param log: name of the timestamp log of the video, recorded in the manifest
+        :type: str
+        """
+        self.stem, self.extension = os.path.splitext(filename)
+        self.manifest_filename = self.stem + "-manifest.json"
+        self.fps = fps
+        self.size = size
+        self.fourcc = fourcc
+        self.segment_frames = segment_frames
+        self.is_color = is_color
+        self.manifest = {
+            "fps": fps, "width": size[0], "height": size[1], "fourcc": fourcc,
+            "segment_frames": segment_frames, "log": log, "complete": False, "segments": [],
+        }
+        self.frame_count = 0
+        self._writer = None
+        self._filename = None
+        self._start = 0
+        self._first_timestamp = None
+        self._last_timestamp = None
+        write_json(self.manifest_filename, self.manifest)
+        # Open the first segment now, so that a codec or path error shows before recording
+        self._open()
+
+    def _open(self):
+        self._filename = "{0}-{1:03d}{2}".format(
+            self.stem, len(self.manifest["segments"]), self.extension)
+        self._writer = cv2.VideoWriter(
+            self._filename, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, self.size,
+            self.is_color)
+        if not self._writer.isOpened():
+            raise IOError(f"Cannot open {self._filename} for writing")
+        self._start = self.frame_count
+
+    def _close_segment(self):
+        self._writer.release()
+        self._writer = None
+        if self.frame_count > self._start:
+            self.manifest["segments"].append({
+                "file": os.path.basename(self._filename),
+                "start": self._start,
+                "stop": self.frame_count,
+                "first_timestamp": self._first_timestamp,
+                "last_timestamp": self._last_timestamp,
+            })
+        else:
+            os.remove(self._filename)
+        write_json(self.manifest_filename, self.manifest)
+
+    def write(self, frame, timestamp):
+        """
+        Add a frame, closing the segment once it holds segment_frames frames
+
+        :param frame: image
+        :type: numpy.ndarray
+        :param timestamp: time of the frame in seconds since the first frame
+        :type: float
+        """
+        if self._writer is None:
+            self._open()
+        self._writer.write(frame)
+        if self.frame_count == self._start:
+            self._first_timestamp = timestamp
+        self._last_timestamp = timestamp
+        self.frame_count += 1
+        if self.frame_count - self._start >= self.segment_frames:
+            self._close_segment()
+
+    def release(self):
+        """
+        Close the last segment and mark the manifest complete
+        """
+        if self._writer is not None:
+            self._close_segment()
+        self.manifest["complete"] = True
+        write_json(self.manifest_filename, self.manifest)
+
+
+class CapturePipeline:
+    """
+    Grab thread, video writer thread and logging thread of one camera, connected by a
+    RingBuffer. The grab thread only copies images into the ring; encoding, timestamps and
+    status lines are handled by the other threads, so they cannot delay a grab.
+    """
+
+    def __init__(self, camera, filename, fps, capacity=ring_capacity,
+                 status_interval=status_interval, fourcc="MJPG", trigger_state=None, cpus=None,
+                 segment_frames=maximum_frame_count_per_file):
+        """
+        :param camera: camera to record
+        :type: Camera
+        :param filename: path to the video; written as segments, see SegmentedVideoWriter
+        :type: str
+        :param fps: frame rate of the camera
+        :type: float
+        :param capacity: number of frames the ring buffer can hold
+        :type: int
+        :param status_interval: seconds between two status lines
+        :type: float
+        :param fourcc: four character code of the video codec; Motion JPEG by default
+        :type: str
+        :param trigger_state: function returning the state of the trigger input, logged with
+        each batch of frames; 0 is logged if unspecified
+        :type: callable
+        :param cpus: CPUs of the 'grab', 'writer' and 'log' threads, see schedule_cpus
+        :type: dict
+        :param segment_frames: maximum number of frames in one video segment
+        :type: int
+        """
+        self.camera = camera
+        self.filename = filename
+        self.fps = fps
+        self.status_interval = status_interval
+        self.ring = RingBuffer(capacity, (camera.height, camera.width))
+        self.log_basename = os.path.splitext(filename)[0] + "-timestamp"
+        self.writer = SegmentedVideoWriter(
+            filename, fps, (camera.width, camera.height), fourcc, segment_frames,
+            log=os.path.basename(self.log_basename) + ".npy")
+        self.frames_written = 0
+        self.trigger_state = trigger_state
+        self.cpus = cpus or {}
+        self.log = None
+        self._threads = []
+        self._stop = threading.Event()
+        self._closed = False
+        self.error = None
+
+    def start(self, n_frames, reference_ns=None):
+        """
+        Start the camera and the three threads
+
+        :param n_frames: number of frames to grab
+        :type: int
+        :param reference_ns: time.perf_counter_ns() of the start of the session, see TimestampLog
+        :type: int
+        """
+        self.log = TimestampLog(self.log_basename, n_frames, reference_ns)
+        self.camera.start(n_frames)
+        self._threads = [
+            threading.Thread(target=self._run_thread, args=(loop,), name=f"{name} {self.filename}",
+                             daemon=True)
+            for name, loop in (("grab", self._grab_loop), ("writer", self._write_loop),
+                               ("log", self._log_loop))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """
+        End the acquisition early, i.e. on an error; join() still writes out the frames in the ring
+        """
+        self._stop.set()
+
+    def close(self):
+        """
+        Wait until the acquisition ends and the readers have drained the ring, then close the
+        video, its manifest and the timestamp log. An error of the threads is kept in
+        self.error, see join
+        """
+        for thread in self._threads:
+            thread.join()
+        if not self._closed:
+            self._closed = True
+            self.writer.release()
+            self.log.close()
+
+    def join(self):
+        """
+        Close the pipeline (see close) and raise the error that stopped a thread, if any
+
+        :return: ring buffer statistics and number of frames written
+        :type: dict
+        """
+        self.close()
+        if self.error is not None:
+            raise self.error
+        stats = self.ring.stats()
+        stats["written"] = self.frames_written
+        stats["logged"] = self.log.count
+        return stats
+
+    def run(self, n_frames, reference_ns=None):
+        """
+        Record n_frames frames
+
+        :return: ring buffer statistics and number of frames written
+        :type: dict
+        """
+        self.start(n_frames, reference_ns)
+        return self.join()
+
+    def _run_thread(self, loop):
+        try:
+            loop()
+        except BaseException as error:
+            # Stop the acquisition: the grab thread ends and the other threads drain the ring
+            if self.error is None:
+                self.error = error
+            self._stop.set()
+            self.ring.close()
+
+    def _grab_loop(self):
+        pin_thread(self.cpus.get("grab"))
+        ring = self.ring
+        scratch = np.empty(ring.frames.shape[1:], dtype=ring.frames.dtype)
+        try:
+            while self.camera.is_grabbing and not self._stop.is_set():
+                slot = ring.reserve()
+                result = self.camera.grab(scratch if slot is None else ring.frames[slot])
+                if result is None:
+                    continue
+                if slot is None:
+                    ring.drop(*result, time.perf_counter_ns())
+                else:
+                    ring.commit(*result, time.perf_counter_ns())
+        finally:
+            self.camera.stop()
+            ring.close()
+
+    def _write_loop(self):
+        pin_thread(self.cpus.get("writer"))
+        ring = self.ring
+        clock = VideoClock(self.fps)
+        while True:
+            available = ring.wait("writer")
+            if len(available) == 0:
+                break
+            for position in available:
+                slot = position % ring.capacity
+                timestamp = ring.timestamps[slot]
+                # Calculate frame number in case of frame drop.
+                frame_no = clock.advance(timestamp)
+                # Repeat the frame over the dropped ones so the video keeps its timing
+                while self.frames_written <= frame_no:
+                    self.writer.write(
+                        ring.frames[slot], (timestamp - clock.first_timestamp) / 1e9)
+                    self.frames_written += 1
+            ring.release("writer", len(available))
+
+    def _log_loop(self):
+        pin_thread(self.cpus.get("log"))
+        ring = self.ring
+        clock = VideoClock(self.fps)
+        last_status = time.monotonic()
+        while True:
+            available, dropped = ring.wait("log", timeout=self.status_interval, dropped=True)
+            if len(available) == 0 and not dropped and ring.closed:
+                break
+            if len(available) > 0 or dropped:
+                slots = np.arange(available.start, available.stop) % ring.capacity
+                dropped = np.array(dropped, dtype=np.int64).reshape(-1, 3)
+                frame_ids = np.concatenate((ring.frame_ids[slots], dropped[:, 0]))
+                device_ns = np.concatenate((ring.timestamps[slots], dropped[:, 1]))
+                host_ns = np.concatenate((ring.host_times[slots], dropped[:, 2]))
+                written = np.repeat(np.array([1, 0], dtype=np.uint8), (len(slots), len(dropped)))
+                # Log the dropped frames in time order with the written ones, at the position
+                # the writer gives them
+                order = np.argsort(device_ns, kind="stable")
+                video_frames = np.array([
+                    clock.advance(t) if w else clock.nominal(t)
+                    for t, w in zip(device_ns[order], written[order])
+                ], dtype=np.int64)
+                trigger = 0 if self.trigger_state is None else self.trigger_state()
+                self.log.append(frame_ids[order], device_ns[order], host_ns[order], trigger,
+                                video_frames, written[order])
+                ring.release("log", len(available))
+            if time.monotonic() - last_status >= self.status_interval:
+                last_status = time.monotonic()
+                stats = ring.stats()
+                print("{0} BlockID={1} {2:.2f} fps ring {3}/{4} dropped {5}".format(
+                      os.path.basename(self.filename),
+                      ring.frame_ids[(ring.head - 1) % ring.capacity],
+                      self.camera.current_fps, stats["occupancy"],
+                      stats["capacity"], stats["dropped"]))
+
+
+class MultiCameraRecorder:
+    """
+    Records several cameras in one process, started together by one shared trigger. Each camera
+    has its own CapturePipeline (grab, writer and logging threads, video and timestamp log),
+    and the threads are spread over the CPUs with schedule_cpus.
+    """
+
+    def __init__(self, cameras, filenames, fps, trigger=None, cpus=None, **kwargs):
+        """
+        :param cameras: cameras to record
+        :type: list of Camera
+        :param filenames: path to the video file of each camera
+        :type: list of str
+        :param fps: frame rate of the cameras
+        :type: float
+        :param trigger: start trigger; the cameras start immediately if unspecified
+        :type: LabJackTrigger
+        :param cpus: CPUs of the threads of each camera; schedule_cpus(len(cameras)) if unspecified
+        :type: list of dict
+        :param kwargs: other arguments of CapturePipeline
+        """
+        if len(cameras) != len(filenames):
+            raise ValueError("One filename is needed per camera")
+        if cpus is None:
+            cpus = schedule_cpus(len(cameras))
+        self.trigger = trigger
+        self.fps = fps
+        self.pipelines = [
+            CapturePipeline(
+                camera, filename, fps, cpus=camera_cpus,
+                trigger_state=None if trigger is None else trigger.state, **kwargs)
+            for camera, filename, camera_cpus in zip(cameras, filenames, cpus)
+        ]
+        self.edge_ns = None
+
+    def run(self, n_frames, timeout=None):
+        """
+        Wait for the trigger, then record n_frames frames with every camera. If anything
+        interrupts the recording, the cameras are stopped and the frames grabbed so far are
+        written out (videos, manifests and logs) before the exception propagates.
+
+        :param n_frames: number of frames to grab per camera
+        :type: int
+        :param timeout: seconds to wait for the trigger; forever if unspecified
+        :type: float
+
+        :return: statistics of each pipeline, see CapturePipeline.join
+        :type: list of dict
+        """
+        if self.trigger is None:
+            self.edge_ns = time.perf_counter_ns()
+        else:
+            print("waiting for trigger")
+            self.edge_ns = self.trigger.wait(timeout)
+        started = []
+        try:
+            for pipeline in self.pipelines:
+                pipeline.start(n_frames, reference_ns=self.edge_ns)
+                started.append(pipeline)
+            return [pipeline.join() for pipeline in started]
+        except BaseException:
+            for pipeline in started:
+                pipeline.stop()
+            for pipeline in started:
+                pipeline.close()
+            raise
+
+    def metadata(self):
+        """
+        :return: session metadata: trigger, and for each camera its files (video manifest and
+        timestamp log), statistics and the measured latency from the trigger to its first frame
+        :type: dict
+        """
+        metadata = {"fps": self.fps}
+        if self.trigger is not None:
+            metadata.update(self.trigger.metadata())
+        cameras = []
+        for pipeline in self.pipelines:
+            camera = {
+                "video": pipeline.filename,
+                "manifest": pipeline.writer.manifest_filename,
+                "log": pipeline.log_basename + ".npy",
+            }
+            camera.update(pipeline.ring.stats())
+            camera["written"] = pipeline.frames_written
+            if pipeline.log is None:
+                # Not started
+                cameras.append(camera)
+                continue
+            camera["logged"] = pipeline.log.count
+            if pipeline.log.count > 0:
+                first_frame_ns = int(pipeline.log.records["host_ns"][0])
+                camera["first_frame_ns"] = first_frame_ns
+                camera["trigger_to_first_frame_ns"] = first_frame_ns - self.edge_ns
+            cameras.append(camera)
+        metadata["cameras"] = cameras
+        return metadata
+
+
+def open_st_cameras(n_cameras, fps):
+    """
+    Connect to n_cameras StApi cameras
+
+    :return: the StApi system, which must be kept while recording, and the cameras
+    :type: tuple
+    """
+    import stapipy as st
+
+    # Initialize StApi before using.
+    st.initialize()
+
+    # Create a system object for device scan and connection.
+    st_system = st.create_system()
+
+    cameras = []
+    for _ in range(n_cameras):
+        # Connect to the first detected device that is not connected yet.
+        st_device = st_system.create_first_device()
+
+        # Display DisplayName of the device.
+        print('Device=', st_device.info.display_name)
+        cameras.append(StCamera(st_device, fps))
+    return st_system, cameras
+
+
+if __name__ == "__main__":
+    try:
+        import u3 # This is using LabJack on laptop to do sync!
+
+        #Device:LabJack U3
+        d = u3.U3()
+
+        st_system, cameras = open_st_cameras(len(camera_names), fps)
+
+        # Register video files
+        sep = "-"
+        date = datetime.today().strftime('%Y%m%d')
+        filenames = [savepath + "/" + sep.join((date, name)) + ".avi" for name in camera_names]
+
+        #print("Trigger received. Waiting for record")
+        #while not camera_pin.value:
+        #    pass
+
+        # Each video is written as <date>-<name>-000.avi, -001.avi, ... described by
+        # <date>-<name>-manifest.json
+        recorder = MultiCameraRecorder(cameras, filenames, fps, trigger=LabJackTrigger(d))
+        try:
+            for name, stats in zip(camera_names, recorder.run(number_of_images_to_grab)):
+                print(name, stats)
+        finally:
+            # Session metadata, with the measured latency from the trigger to the first frames;
+            # also written if the recording failed
+            write_json(savepath + "/" + sep.join((date, "session.json")), recorder.metadata())
+
+        # The timestamps were logged to <date>-<name>-timestamp.npy/.raw during the
+        # acquisition; the CSV is an optional export
+        for pipeline in recorder.pipelines:
+            TimestampLog.export_csv(pipeline.log_basename + ".npy", pipeline.log_basename + ".csv")
+        print('done')
+    except Exception as exception:
+        print(exception)
@@ -8,6 +8,9 @@ This module can generate file names, return a complete path to a file, and save
 used by the source data is maintained.
 """
 
+import hashlib
+import itertools
+import json
 import os
 import numpy as np
 import matplotlib.pyplot as plt
@@ -17,12 +20,372 @@ from os.path import join, getsize, isfile, isdir
 from pathlib import Path
 from dateutil.parser import parse 
 import sys, traceback
+import time
+import zlib
+
+
+FNAMES = [
+    'timestamps',
+    'subset interpolated',
+    'interpolated',
+    'h264', 
+    'combined', 
+    'processed',
+    'RM mask',
+    'LM mask', 
+    'left blue', 
+    'left green', 
+    'right blue',
+    'right green', 
+    'left blue 0.01-3.0Hz', 
+    'left green 0.01-3.0Hz', 
+    'right blue 0.01-3.0Hz',
+    'right green 0.01-3.0Hz',
+    'left blue 0.01-12.0Hz', 
+    'left green 0.01-12.0Hz', 
+    'right blue 0.01-12.0Hz',
+    'right green 0.01-12.0Hz',
+    'left 0.01-12.0Hz',
+    'right 0.01-12.0Hz',
+    'left 0.01-3.0Hz',
+    'right 0.01-3.0Hz',
+    'left',
+    'right',
+    'left timestamps',
+    'right timestamps',
+    'freq split ws=3800',
+    'freq split ws=5000',
+    'freq split ws=1000',
+    'freq split ws=1500',
+    'freq split ws=1750',
+    'freq split ws=2500',
+    'freq split ws=864',
+    'freq split ws=432',
+    'freq split ws=2000',
+    'freq split ws=2800',
+    'trunc',
+    'left gsr',
+    'right gsr',
+    'left global',
+    'right global',
+    'matlab'
+]
+
+
+def _matches(f, fname, subfolder=""):
+    """
+    Returns True if the file name f is the file called fname in the naming convention of the
+    source data. Used by Data.file and Catalogue to resolve the names listed in FNAMES.
+
+    :param f: name of a file in the experiment folder
+    :type: str
+    :param fname: one of FNAMES
+    :type: str
+    :param subfolder: 'Behaviour' for the behaviour naming convention; otherwise '' or 'Derivatives'
+    :type: str
+
+    :return: whether f matches fname
+    :type: bool
+    """
+    if subfolder == 'Behaviour':
+        if 'timestamps' in f and fname == 'timestamps':
+            return True
+        elif 'subset_interpolated' in f and fname == 'subset interpolated':
+            return True
+        elif 'interpolated' in f and fname == 'interpolated':
+            return True
+        elif 'h264' in f and fname == 'h264':
+            return True
+        return False
+
+    else:
+        if 'combined' in f and 'raw' in f and 'upscaled' not in f:
+            if not 'gsr' in f:
+
+                if '0.01-3' in f:
+                    if fname == 'combined':
+                        return True
+        elif 'left_mouse_gsr' in f and fname == "left gsr":
+            return True
+        elif 'right_mouse_gsr' in f and fname == "right gsr":
+            return True
+        elif 'l_global_signal' in f and fname == "left global":
+            return True
+        elif 'r_global_signal' in f and fname == "right global":
+            return True
+#         elif 'snips' in f and fname == "matlab":
+#             return True
+        elif 'processed' in f and fname == 'processed':
+            return True
+        elif 'RM_mask' in f and fname == 'RM mask':
+            return True
+        elif 'LM_mask' in f and fname == 'LM mask':
+            return True
+
+        elif 'frequency_split_correlation_filtered_ws' in f:
+            if '3800' in f and fname == 'freq split ws=3800':
+                return True
+            if '5000' in f and fname == 'freq split ws=5000':
+                return True
+            if '1000' in f and fname == 'freq split ws=1000':
+                return True
+            if '1500' in f and fname == 'freq split ws=1500':
+                return True
+            if '1750' in f and fname == 'freq split ws=1750':
+                return True
+            if '2500' in f and fname == 'freq split ws=2500':
+                return True
+            if '864' in f and fname == 'freq split ws=864':
+                return True
+            if '432' in f and fname == 'freq split ws=432':
+                return True
+            if '2000' in f and fname == 'freq split ws=2000':
+                return True
+            if '2800' in f and fname == 'freq split ws=2800':
+                return True
+
+        elif 'BLUE' in f:
+            if 'LEFT' in f:
+                if 'RAW' in f and fname == 'left blue':
+                    return True
+                if '0.01-3.0' in f and fname == 'left blue 0.01-3.0Hz':
+                    return True
+                if '0.01-12.0' in f and fname == 'left blue 0.01-12.0Hz':
+                    return True
+            if 'RIGHT' in f:
+                if 'RAW' in f and fname == 'right blue':
+                    return True
+                if '0.01-3.0' in f and fname == 'right blue 0.01-3.0Hz':
+                    return True
+                if '0.01-12.0' in f and fname == 'right blue 0.01-12.0Hz':
+                    return True
+        elif 'GREEN' in f:
+            if 'LEFT' in f:
+                if 'RAW' in f and fname == 'left green':
+                    return True
+                if '0.01-3.0' in f and 'TRUNCATED.npy' in f and fname == 'trunc':
+                    return True
+                if '0.01-3.0' in f and fname == 'left green 0.01-3.0Hz':
+                    return True
+                if '0.01-12.0' in f and fname == 'left green 0.01-12.0Hz' and "mp4" not in f:
+                    return True
+            if 'RIGHT' in f:
+                if 'RAW' in f and fname == 'right green':
+                    return True
+                if '0.01-3.0' in f and fname == 'right green 0.01-3.0Hz':
+                    return True
+                if '0.01-12.0' in f and fname == 'right green 0.01-12.0Hz' and 'mp4' not in f:
+                    return True
+
+        elif 'LEFT_corrected' in f:
+            if '0.01-3.0' in f and fname == 'left 0.01-3.0Hz':
+                return True
+            if '0.01-12.0' in f and fname == 'left 0.01-12.0Hz' and "mp4" not in f:
+                return True
+        elif 'RIGHT_corrected' in f:
+            if '0.01-3.0' in f and fname == 'right 0.01-3.0Hz':
+                return True
+            if '0.01-12.0' in f and fname == 'right 0.01-12.0Hz':
+                return True
+
+        elif not 'LEFT' in f and not 'RIGHT' in f:
+            if len(f) > 5 and f[5] == 'L':
+                if 'timestamps' in f and fname == 'left timestamps':
+                    return True
+                if not 'bandpass' in f and fname == 'left':
+                    return True
+            if len(f) > 5 and f[5] == 'R':
+                if 'timestamps' in f and fname == 'right timestamps':
+                    return True
+                if not 'bandpass' in f and fname == 'right':
+                    return True
+
+        return False
+
+
+class Catalogue:
+    """
+    Persistent index of a data root, mapping (experiment, subfolder, file name) to the
+    complete path of the file, so that Data.experiment and Data.file do not walk the
+    experiment folders on every lookup. The index is kept in a JSON file in the data root;
+    an experiment is rescanned only when one of its folders has been modified since it was indexed.
+    """
+
+    SUBFOLDERS = ("", "Derivatives", "Behaviour")
+
+
+    def __init__(self, directory, index_file=None):
+        """
+        :param directory: the data root, containing one folder per date
+        :type: str
+        :param index_file: path to the JSON index; defaults to .librain_index.json in directory
+        :type: str
+        """
+        self.directory = str(directory)
+        if index_file is None:
+            index_file = os.path.join(self.directory, '.librain_index.json')
+        self.index_file = index_file
+        self.experiments = {}
+        if isfile(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    self.experiments = json.load(f)['experiments']
+            except (OSError, ValueError, KeyError):
+                print(f'Index {self.index_file} is unreadable and will be rebuilt')
+        self.refresh()
+
+
+    def key(self, exp_folder):
+        """
+        Returns the index key of an experiment folder, i.e. '20230514/Experiment_1', 
+        or None if the folder is not in the data root.
+
+        :param exp_folder: complete path to experiment folder
+        :type: str
+
+        :return: key of the experiment
+        :type: str
+        """
+        try:
+            rel = os.path.relpath(str(exp_folder), self.directory)
+        except ValueError:
+            # On another drive than the data root (Windows); the folder is used by its absolute path
+            return None
+        if rel.startswith('..') or os.path.isabs(rel):
+            return None
+        return Path(rel).as_posix()
+
+
+    def refresh(self):
+        """
+        Rescans the experiments that were added or modified since they were indexed and
+        forgets the ones that were removed. The index is saved if anything changed.
+        """
+        found = set()
+        changed = False
+        for date in os.listdir(self.directory):
+            date_path = os.path.join(self.directory, date)
+            if isdir(date_path) is False:
+                continue
+            for exp in os.listdir(date_path):
+                if not exp.startswith('Experiment_'):
+                    continue
+                key = f'{date}/{exp}'
+                found.add(key)
+                if self._stale(key):
+                    self._scan(key)
+                    changed = True
+        for key in set(self.experiments) - found:
+            del self.experiments[key]
+            changed = True
+        if changed:
+            self.save()
+
+
+    def refresh_experiment(self, key):
+        """
+        Rescans one experiment if it was modified since it was indexed.
+
+        :param key: key of the experiment, see Catalogue.key
+        :type: str
+        """
+        if self._stale(key):
+            if isdir(os.path.join(self.directory, key)):
+                self._scan(key)
+            else:
+                self.experiments.pop(key, None)
+            self.save()
+
+
+    def path(self, key, fname, subfolder=""):
+        """
+        Returns the indexed path of fname in an experiment, or None if it is not indexed.
+
+        :param key: key of the experiment, see Catalogue.key
+        :type: str
+        :param fname: one of FNAMES
+        :type: str
+        :param subfolder: one of '', 'Derivatives' or 'Behaviour'
+        :type: str
+
+        :return: complete path to fname
+        :type: str
+        """
+        experiment = self.experiments.get(key)
+        if experiment is None:
+            return None
+        return experiment['files'].get(subfolder, {}).get(fname)
+
+
+    def save(self):
+        """
+        Writes the index to self.index_file, replacing the previous one atomically.
+        """
+        tmp = self.index_file + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': 1, 'experiments': self.experiments}, f)
+            os.replace(tmp, self.index_file)
+        except OSError as error:
+            print(f'Could not save index {self.index_file}: {error}')
+
+
+    def _stale(self, key):
+        experiment = self.experiments.get(key)
+        if experiment is None:
+            return True
+        for rel, mtime in experiment['dirs'].items():
+            try:
+                if os.stat(os.path.join(self.directory, key, rel)).st_mtime != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+
+    def _scan(self, key):
+        # One walk of the experiment; the walks of its subfolders visit the same
+        # files in the same order, so the first match of each name is kept for each subfolder
+        exp_folder = os.path.join(self.directory, key)
+        dirs = {}
+        files = {subfolder: {} for subfolder in self.SUBFOLDERS}
+        for root, _, fs in os.walk(exp_folder):
+            rel = Path(os.path.relpath(root, exp_folder)).as_posix()
+            dirs[rel] = os.stat(root).st_mtime
+            top = rel.split('/')[0]
+            subfolders = [""] + [top] if top in ("Derivatives", "Behaviour") else [""]
+            for f in fs:
+                for subfolder in subfolders:
+                    names = files[subfolder]
+                    for fname in FNAMES:
+                        if fname not in names and _matches(f, fname, subfolder):
+                            names[fname] = str(Path(os.path.join(root, f)))
+        self.experiments[key] = {
+            'dirs': dirs,
+            'listing': os.listdir(exp_folder),
+            'files': files,
+        }
+
+
 class Data:
 
 
-    def __init__(self, directory):
+    def __init__(self, directory, index=False):
+        """
+        :param directory: the data root, containing one folder per date
+        :type: str
+        :param index: if True, file names are resolved through a Catalogue of directory kept in the
+        data root; if a path, through a Catalogue kept in that file, i.e. a user-local index of a shared root
+        :type: bool or str
+        """
         self.directory = directory
         self.dates = os.listdir(self.directory)
+        if index is True:
+            self.catalogue = Catalogue(directory)
+        elif index:
+            self.catalogue = Catalogue(directory, index_file=str(index))
+        else:
+            self.catalogue = None
 
 
     def experiment(self, date, exp_num, listfiles=False):
@@ -46,6 +409,16 @@ class Data:
         if type(date) == str:
             d_format = parse(date)
             d = f"/{d_format.year}{d_format:%m}{d_format:%d}"
+            if self.catalogue is not None:
+                key = f"{d[1:]}/Experiment_{exp_num}"
+                self.catalogue.refresh_experiment(key)
+                indexed = self.catalogue.experiments.get(key)
+                if indexed is not None:
+                    exp_folder = Path(str(self.directory) + d + f"/Experiment_{exp_num}")
+                    if listfiles is True:
+                        return str(exp_folder), list(indexed['listing'])
+                    else:
+                        return str(exp_folder)
             date_path = Path(str(self.directory) + d) 
             if isdir(date_path) is False:
                 raise Exception(f'Folder {d} does not exist')
@@ -110,68 +483,28 @@ class Data:
         :return: full path to fname 
         :type: str
         """
-        fnames = [
-            'timestamps',
-            'subset interpolated',
-            'interpolated',
-            'h264', 
-            'combined', 
-            'processed',
-            'RM mask',
-            'LM mask', 
-            'left blue', 
-            'left green', 
-            'right blue',
-            'right green', 
-            'left blue 0.01-3.0Hz', 
-            'left green 0.01-3.0Hz', 
-            'right blue 0.01-3.0Hz',
-            'right green 0.01-3.0Hz',
-            'left blue 0.01-12.0Hz', 
-            'left green 0.01-12.0Hz', 
-            'right blue 0.01-12.0Hz',
-            'right green 0.01-12.0Hz',
-            'left 0.01-12.0Hz',
-            'right 0.01-12.0Hz',
-            'left 0.01-3.0Hz',
-            'right 0.01-3.0Hz',
-            'left',
-            'right',
-            'left timestamps',
-            'right timestamps',
-            'freq split ws=3800',
-            'freq split ws=5000',
-            'freq split ws=1000',
-            'freq split ws=1500',
-            'freq split ws=1750',
-            'freq split ws=2500',
-            'freq split ws=864',
-            'freq split ws=432',
-            'freq split ws=2000',
-            'freq split ws=2800',
-            'trunc',
-            'left gsr',
-            'right gsr',
-            'left global',
-            'right global',
-            'matlab'
-            ]
-
-        if fname not in fnames:
+
+        if fname not in FNAMES:
             raise ValueError(f'{fname} is not a valid filename. Check help(<directory>.file) for a list of filenames')
 
+        key = self.catalogue.key(exp_folder) if self.catalogue is not None else None
+        if key is not None and subfolder in Catalogue.SUBFOLDERS:
+            path = self.catalogue.path(key, fname, subfolder)
+            if path is None or isfile(path) is False:
+                # The experiment may have changed since it was indexed
+                self.catalogue.refresh_experiment(key)
+                path = self.catalogue.path(key, fname, subfolder)
+            if path is not None and isfile(path) is True:
+                if fname == 'combined' and subfolder != 'Behaviour':
+                    return Path(path)
+                return path
+
         if subfolder == 'Behaviour':   
             direc = os.path.join(str(exp_folder), subfolder)        
             for root, dirs, files in os.walk(direc): 
                 for f in files:
-                    if 'timestamps' in f and fname == 'timestamps':
-                        return str(Path(os.path.join(root, f)))
-                    elif 'subset_interpolated' in f and fname == 'subset interpolated':
-                        return str(Path(os.path.join(root, f)))
-                    elif 'interpolated' in f and fname == 'interpolated':
+                    if _matches(f, fname, subfolder):
                         return str(Path(os.path.join(root, f)))
-                    elif 'h264' in f and fname == 'h264':
-                        return str(Path(os.path.join(root, f))) 
 
             raise FileNotFoundError(f'File {fname} does not exist in subfolder {subfolder}') 
         
@@ -179,107 +512,10 @@ class Data:
             direc = os.path.join(str(exp_folder), subfolder) 
             for root, dirs, files in os.walk(direc):
                 for f in files:
-                    if 'combined' in f and 'raw' in f and 'upscaled' not in f:
-                        if not 'gsr' in f:
-                            
-                            if '0.01-3' in f:
-                                if fname == 'combined':
-                                    return Path(os.path.join(root, f))
-                    elif 'left_mouse_gsr' in f and fname == "left gsr":
+                    if _matches(f, fname, subfolder):
+                        if fname == 'combined':
+                            return Path(os.path.join(root, f))
                         return str(Path(os.path.join(root, f)))
-                    elif 'right_mouse_gsr' in f and fname == "right gsr":
-                        return str(Path(os.path.join(root, f)))
-                    elif 'l_global_signal' in f and fname == "left global":
-                        return str(Path(os.path.join(root, f))) 
-                    elif 'r_global_signal' in f and fname == "right global":
-                        return str(Path(os.path.join(root, f))) 
-#                     elif 'snips' in f and fname == "matlab":
-#                         return str(Path(os.path.join(root, f)))                    
-                    elif 'processed' in f and fname == 'processed':
-                        return str(Path(os.path.join(root, f)))
-                    elif 'RM_mask' in f and fname == 'RM mask':
-                        return str(Path(os.path.join(root, f)))
-                    elif 'LM_mask' in f and fname == 'LM mask':
-                        return str(Path(os.path.join(root, f)))
-
-                    elif 'frequency_split_correlation_filtered_ws' in f:
-                        if '3800' in f and fname == 'freq split ws=3800':
-                            return str(Path(os.path.join(root, f)))
-                        if '5000' in f and fname == 'freq split ws=5000':
-                            return str(Path(os.path.join(root, f)))
-                        if '1000' in f and fname == 'freq split ws=1000':
-                            return str(Path(os.path.join(root, f)))
-                        if '1500' in f and fname == 'freq split ws=1500':
-                            return str(Path(os.path.join(root, f)))
-                        if '1750' in f and fname == 'freq split ws=1750':
-                            return str(Path(os.path.join(root, f)))
-                        if '2500' in f and fname == 'freq split ws=2500':
-                            return str(Path(os.path.join(root, f)))
-                        if '864' in f and fname == 'freq split ws=864':
-                            return str(Path(os.path.join(root, f)))
-                        if '432' in f and fname == 'freq split ws=432':
-                            return str(Path(os.path.join(root, f)))
-                        if '2000' in f and fname == 'freq split ws=2000':
-                            return str(Path(os.path.join(root, f)))
-                        if '2800' in f and fname == 'freq split ws=2800':
-                            return str(Path(os.path.join(root, f)))
-
-                    elif 'BLUE' in f:
-                        if 'LEFT' in f:
-                            if 'RAW' in f and fname == 'left blue':
-                                return str(Path(os.path.join(root, f)))
-                            if '0.01-3.0' in f and fname == 'left blue 0.01-3.0Hz':
-                                return str(Path(os.path.join(root, f)))
-                            if '0.01-12.0' in f and fname == 'left blue 0.01-12.0Hz':
-                                return str(Path(os.path.join(root, f)))
-                        if 'RIGHT' in f:
-                            if 'RAW' in f and fname == 'right blue':
-                                return str(Path(os.path.join(root, f)))
-                            if '0.01-3.0' in f and fname == 'right blue 0.01-3.0Hz':
-                                return str(Path(os.path.join(root, f)))
-                            if '0.01-12.0' in f and fname == 'right blue 0.01-12.0Hz':
-                                return str(Path(os.path.join(root, f)))   
-                    elif 'GREEN' in f:
-                        if 'LEFT' in f:
-                            if 'RAW' in f and fname == 'left green':
-                                return str(Path(os.path.join(root, f)))
-                            if '0.01-3.0' in f and 'TRUNCATED.npy' in f and fname == 'trunc':
-                                return str(Path(os.path.join(root, f)))
-                            if '0.01-3.0' in f and fname == 'left green 0.01-3.0Hz':
-                                return str(Path(os.path.join(root, f)))
-                            if '0.01-12.0' in f and fname == 'left green 0.01-12.0Hz' and "mp4" not in f:
-                                return str(Path(os.path.join(root, f)))   
-                        if 'RIGHT' in f:
-                            if 'RAW' in f and fname == 'right green':
-                                return str(Path(os.path.join(root, f)))
-                            if '0.01-3.0' in f and fname == 'right green 0.01-3.0Hz':
-                                return str(Path(os.path.join(root, f)))
-                            if '0.01-12.0' in f and fname == 'right green 0.01-12.0Hz' and 'mp4' not in f:
-                                return str(Path(os.path.join(root, f)))   
-                    
-                    elif 'LEFT_corrected' in f:
-                        if '0.01-3.0' in f and fname == 'left 0.01-3.0Hz':
-                            return str(Path(os.path.join(root, f)))
-                        if '0.01-12.0' in f and fname == 'left 0.01-12.0Hz' and "mp4" not in f:
-                            return str(Path(os.path.join(root, f)))
-                    elif 'RIGHT_corrected' in f:
-                        if '0.01-3.0' in f and fname == 'right 0.01-3.0Hz':
-                            return str(Path(os.path.join(root, f)))
-                        if '0.01-12.0' in f and fname == 'right 0.01-12.0Hz':
-                            return str(Path(os.path.join(root, f)))
-
-                    elif not 'LEFT' in f and not 'RIGHT' in f:
-                        if f[5] == 'L':
-                            if 'timestamps' in f and fname == 'left timestamps':
-                                return str(Path(os.path.join(root, f)))
-                            if not 'bandpass' in f and fname == 'left':
-                                return str(Path(os.path.join(root, f)))
-                        if f[5] == 'R':
-                            if 'timestamps' in f and fname == 'right timestamps':
-                                return str(Path(os.path.join(root, f)))
-                            if not 'bandpass' in f and fname == 'right':
-                                return str(Path(os.path.join(root, f)))
-                            
                     
             raise FileNotFoundError(f'File {fname} does not exist in {exp_folder}',)
 
@@ -294,7 +530,8 @@ class Output:
         self.directory = directory
 
 
-    def saveas(self, f_out, ftype, suffix=None, prefix=None, dtype=None, f_in=None, save=False, path=None, dirname="Derivatives", fig=False):
+    def saveas(self, f_out, ftype, suffix=None, prefix=None, dtype=None, f_in=None, save=False, path=None, dirname="Derivatives", fig=False, 
+               chunks=None, metadata=None):
         """
         Returns file name of a result with the same naming convention as the corresponding raw data. 
         The result can also be saved.
@@ -303,11 +540,11 @@ class Output:
         :type: any
         :param suffix: word or phrase to append to the end of the file name (i.e. <file>_PROCESSED) OR unique file name
         :type: str
-        :param ftype: desired file type
+        :param ftype: desired file type; 'chunks' saves f_out as a ChunkedArray directory
         :type: str
         :param prefix: word or phrase to append to the beginning of the file name (i.e. LEFT_GREEN_<file>)
         :type: str
-        :param dtype: desired numpy data type, i.e. 'float32'; ftype must be set to 'raw'
+        :param dtype: desired numpy data type, i.e. 'float32'; ftype must be set to 'raw' or 'chunks'
         :type: str
         :param f_in: complete path to raw file from which the result was derived; leave out to customize file name
         :type: str 
@@ -320,6 +557,11 @@ class Output:
         :type: str
         :param fig: must be set to True if f_out is a figure; the file is saved in npy format otherwise
         :type: bool
+        :param chunks: chunk shape if ftype is 'chunks', i.e. (256, 64, 64); see ChunkedArray
+        :type: tuple
+        :param metadata: attributes saved with the array if ftype is 'chunks', i.e. 
+        {'frame_rate': 30, 'channel': 'green', 'band': [0.01, 12.0]}; f_in is saved as 'source'
+        :type: dict
 
         :return: file name of result
         :type: str
@@ -327,14 +569,14 @@ class Output:
         if path == None:
             direc = self.directory + f'/{dirname}/'
             if isdir(direc) is False:
-                direc = os.mkdir(direc)
+                os.mkdir(direc)
         else:
             if isdir(path) is False:
                 raise FileNotFoundError(f'{path} does not exist')
             else:
                 direc = path + f'/{dirname}/'
                 if isdir(direc) is False:
-                    direc = os.mkdir(direc)
+                    os.mkdir(direc)
 
         if f_in == None:
             fname = suffix + f'.{ftype}'
@@ -370,7 +612,14 @@ class Output:
                 print(f'Saved as {fname}')
                 return fname
             else:
-                if ftype == 'raw':
+                if ftype == 'chunks':
+                    metadata = dict(metadata or {})
+                    if f_in != None:
+                        metadata.setdefault('source', str(f_in))
+                    ChunkedArray.from_array(str(path), f_out, chunks=chunks, metadata=metadata, dtype=dtype)
+                    print(f'Saved as {fname}')
+                    return fname
+                elif ftype == 'raw':
                     if dtype == None:
                         f_out.tofile(direc+fname)
                         print(f'Saved as {fname}')
@@ -389,3 +638,617 @@ class Output:
 
 
 
+
+
+class ChunkedArray:
+    """
+    Array stored on disk as a directory of zlib-compressed chunks, i.e. (time chunk x spatial tile)
+    for a stack of frames, with its shape, dtype and metadata (frame rate, channel, filter band,
+    source file, ...) in meta.json. Time ranges, spatial windows and pixel masks are read
+    without loading the whole array.
+
+    Frames are written in time order with append; use ChunkedArray.from_array to save a complete array.
+    """
+
+    META = 'meta.json'
+
+
+    def __init__(self, path, mode='r', shape=None, dtype=None, chunks=None, metadata=None, level=1):
+        """
+        :param path: directory of the store
+        :type: str
+        :param mode: 'r' to read, 'w' to create (overwriting an existing store) or 'a' to append to an existing store
+        :type: str
+        :param shape: shape of one frame, i.e. (height, width); mode 'w' only
+        :type: tuple
+        :param dtype: numpy data type of the array; mode 'w' only
+        :type: str
+        :param chunks: chunk shape, i.e. (256, 64, 64) for 256 frames x 64 x 64 pixel tiles; mode 'w' only
+        :type: tuple
+        :param metadata: JSON serializable attributes saved with the array; mode 'w' only
+        :type: dict
+        :param level: zlib compression level, 0-9
+        :type: int
+        """
+        if mode not in ('r', 'w', 'a'):
+            raise ValueError(f"mode must be 'r', 'w' or 'a', not {mode}")
+        self.path = str(path)
+        self.mode = mode
+        if mode == 'w':
+            if shape is None or dtype is None:
+                raise ValueError("shape and dtype must be specified in mode 'w'")
+            shape = (0,) + tuple(int(s) for s in shape)
+            if chunks is None:
+                chunks = (256,) + (64,) * (len(shape) - 1)
+            if len(chunks) != len(shape):
+                raise ValueError(f'chunks {chunks} do not match a stack of frames of shape {shape[1:]}')
+            os.makedirs(self.path, exist_ok=True)
+            for f in os.listdir(self.path):
+                # Only the chunks and metadata of a previous array are removed
+                if f == self.META or f.replace('.', '').isdigit():
+                    os.remove(os.path.join(self.path, f))
+            self.shape = shape
+            self.dtype = np.dtype(dtype)
+            self.chunks = tuple(int(c) for c in chunks)
+            self.metadata = dict(metadata or {})
+            self.level = level
+            self._save_meta()
+        else:
+            with open(os.path.join(self.path, self.META)) as f:
+                meta = json.load(f)
+            self.shape = tuple(meta['shape'])
+            self.dtype = np.dtype(meta['dtype'])
+            self.chunks = tuple(meta['chunks'])
+            self.metadata = meta['metadata']
+            self.level = meta.get('level', level)
+        self._pending = np.empty((0,) + self.shape[1:], self.dtype)
+        if mode == 'a' and self.shape[0] % self.chunks[0] != 0:
+            # The last time chunk is incomplete; it is rewritten by the next append
+            n = self.shape[0] % self.chunks[0]
+            self._pending = self[self.shape[0] - n:]
+            self.shape = (self.shape[0] - n,) + self.shape[1:]
+
+
+    @classmethod
+    def from_array(cls, path, frames, chunks=None, metadata=None, dtype=None, level=1):
+        """
+        Saves an array, i.e. a stack of frames or a numpy.memmap, as a chunked array.
+
+        :param path: directory of the store
+        :type: str
+        :param frames: array whose first axis is time
+        :type: numpy.ndarray
+        :param chunks: chunk shape; see ChunkedArray.__init__
+        :type: tuple
+        :param metadata: JSON serializable attributes saved with the array
+        :type: dict
+        :param dtype: numpy data type of the saved array; the data type of frames if unspecified
+        :type: str
+        :param level: zlib compression level, 0-9
+        :type: int
+
+        :return: the store, opened for reading
+        :type: ChunkedArray
+        """
+        dtype = frames.dtype if dtype is None else dtype
+        with cls(path, 'w', frames.shape[1:], dtype, chunks, metadata, level) as store:
+            step = store.chunks[0]
+            for start in range(0, frames.shape[0], step):
+                store.append(frames[start:start + step])
+        return cls(path)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+
+    def append(self, frames):
+        """
+        Appends frames at the end of the array. Complete time chunks are compressed and written
+        immediately; the remainder is written by the next append or by close.
+
+        :param frames: frames of shape (n_frames,) + frame shape
+        :type: numpy.ndarray
+        """
+        if self.mode == 'r':
+            raise ValueError('Array is opened for reading')
+        frames = np.asarray(frames)
+        if frames.shape[1:] != self.shape[1:]:
+            raise ValueError(f'Frames of shape {frames.shape[1:]} cannot be appended to frames of shape {self.shape[1:]}')
+        if len(self._pending) > 0:
+            frames = np.concatenate([self._pending, frames.astype(self.dtype, copy=False)])
+        n = self.chunks[0]
+        full = len(frames) - len(frames) % n
+        for start in range(0, full, n):
+            self._write_time_chunk(frames[start:start + n])
+        self._pending = np.array(frames[full:], self.dtype)
+
+
+    def flush(self):
+        """
+        Writes the incomplete last time chunk and the metadata. Appending after a flush rewrites that chunk.
+        """
+        if self.mode == 'r':
+            return
+        if len(self._pending) > 0:
+            t = self.shape[0] // self.chunks[0]
+            for index, tile in self._tiles(self._pending):
+                self._write_chunk((t,) + index, tile)
+        self._save_meta(self.shape[0] + len(self._pending))
+
+
+    def close(self):
+        self.flush()
+        self.mode = 'r'
+        if len(self._pending) > 0:
+            self.shape = (self.shape[0] + len(self._pending),) + self.shape[1:]
+            self._pending = self._pending[:0]
+
+
+    def __getitem__(self, key):
+        """
+        Reads a slice of the array; only the chunks overlapping the slice are decompressed.
+        Integers and slices are supported on every axis, i.e. store[1000:2000, 64:128, :].
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > self.ndim:
+            raise IndexError(f'too many indices for array of shape {self.shape}')
+        key = key + (slice(None),) * (self.ndim - len(key))
+        bounds = []
+        select = []
+        for k, size in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(size)
+                if step < 0:
+                    raise IndexError('negative steps are not supported')
+                stop = max(stop, start)
+                bounds.append((start, stop))
+                select.append(slice(0, stop - start, step))
+            else:
+                k = int(k)
+                if k < 0:
+                    k += size
+                if not 0 <= k < size:
+                    raise IndexError(f'index {k} is out of bounds for axis with size {size}')
+                bounds.append((k, k + 1))
+                select.append(0)
+        return self._read(bounds)[tuple(select)]
+
+
+    def masked(self, mask, start=0, stop=None):
+        """
+        Reads the pixels of a mask over a time range; only the tiles containing pixels
+        of the mask are decompressed.
+
+        :param mask: boolean mask with the shape of one frame
+        :type: numpy.ndarray
+        :param start: first frame
+        :type: int
+        :param stop: frame after the last one; the end of the array if unspecified
+        :type: int
+
+        :return: time series of the pixels of mask, ordered as numpy.nonzero(mask)
+        :type: numpy.ndarray, shape (n_frames, n_pixels)
+        """
+        mask = np.asarray(mask, bool)
+        if mask.shape != self.shape[1:]:
+            raise ValueError(f'mask of shape {mask.shape} does not match frames of shape {self.shape[1:]}')
+        start, stop, _ = slice(start, stop).indices(self.shape[0])
+        stop = max(stop, start)
+        columns = np.cumsum(mask.ravel()).reshape(mask.shape) - 1
+        out = np.empty((stop - start, int(mask.sum())), self.dtype)
+        grid = [range(0, size, c) for size, c in zip(self.shape[1:], self.chunks[1:])]
+        for corner in itertools.product(*grid):
+            tile = tuple(slice(c, c + n) for c, n in zip(corner, self.chunks[1:]))
+            tile_mask = mask[tile]
+            if not tile_mask.any():
+                continue
+            bounds = [(start, stop)] + [(s.start, min(s.stop, size)) for s, size in zip(tile, self.shape[1:])]
+            out[:, columns[tile][tile_mask]] = self._read(bounds)[:, tile_mask]
+        return out
+
+
+    def _read(self, bounds):
+        out = np.empty([stop - start for start, stop in bounds], self.dtype)
+        if out.size == 0:
+            return out
+        ranges = [range(start // c, (stop - 1) // c + 1) for (start, stop), c in zip(bounds, self.chunks)]
+        for index in itertools.product(*ranges):
+            chunk = self._read_chunk(index)
+            src = []
+            dst = []
+            for i, (start, stop), c in zip(index, bounds, self.chunks):
+                lo, hi = max(start, i * c), min(stop, (i + 1) * c)
+                src.append(slice(lo - i * c, hi - i * c))
+                dst.append(slice(lo - start, hi - start))
+            out[tuple(dst)] = chunk[tuple(src)]
+        return out
+
+
+    def _chunk_shape(self, index):
+        return tuple(min(c, size - i * c) for i, c, size in zip(index, self.chunks, self.shape))
+
+
+    def _read_chunk(self, index):
+        with open(os.path.join(self.path, '.'.join(map(str, index))), 'rb') as f:
+            data = zlib.decompress(f.read())
+        return np.frombuffer(data, self.dtype).reshape(self._chunk_shape(index))
+
+
+    def _write_chunk(self, index, chunk):
+        with open(os.path.join(self.path, '.'.join(map(str, index))), 'wb') as f:
+            f.write(zlib.compress(np.ascontiguousarray(chunk, self.dtype).tobytes(), self.level))
+
+
+    def _tiles(self, frames):
+        grid = [range(0, size, c) for size, c in zip(self.shape[1:], self.chunks[1:])]
+        for corner in itertools.product(*grid):
+            index = tuple(c // n for c, n in zip(corner, self.chunks[1:]))
+            tile = (slice(None),) + tuple(slice(c, c + n) for c, n in zip(corner, self.chunks[1:]))
+            yield index, frames[tile]
+
+
+    def _write_time_chunk(self, frames):
+        t = self.shape[0] // self.chunks[0]
+        for index, tile in self._tiles(frames):
+            self._write_chunk((t,) + index, tile)
+        self.shape = (self.shape[0] + len(frames),) + self.shape[1:]
+
+
+    def _save_meta(self, n_frames=None):
+        meta = {
+            'shape': [self.shape[0] if n_frames is None else n_frames] + list(self.shape[1:]),
+            'dtype': self.dtype.str,
+            'chunks': list(self.chunks),
+            'compressor': 'zlib',
+            'level': self.level,
+            'metadata': self.metadata,
+        }
+        tmp = os.path.join(self.path, self.META + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, os.path.join(self.path, self.META))
+
+
+class DerivativeCache:
+    """
+    Content-addressed cache of processing results, i.e. extraction, df/f0, filtering, correction and clustering.
+    Each result is keyed on the content of the files it was derived from, the keys of the upstream results and its
+    parameters, and saved with Output.saveas in the Derivatives folder. Stages are lazy: a result that is already
+    cached is loaded without computing or loading anything upstream of it. The least recently used results are
+    removed when the cache grows beyond its size budget.
+
+    Example:
+        cache = DerivativeCache(path, budget=50 * 2**30)
+        green = cache.stage('extract', vp.extract_RAW_frames, raw_file, channel='green', width=256, height=256)
+        df_f0 = cache.stage('df_f0', vp.calculate_df_f0, green)[0]
+        frames = cache.stage('filter', filt.filter, df_f0, params=filt.params).load()
+    """
+
+    # Seconds between two writes of the index for the last use times of cache hits
+    SAVE_INTERVAL = 60
+
+
+    def __init__(self, directory, budget=None, dirname="Derivatives"):
+        """
+        :param directory: directory in which dirname is created, see Output
+        :type: str
+        :param budget: maximum size of the cached results in bytes; unlimited if unspecified
+        :type: int
+        :param dirname: name of the directory in which the results are saved
+        :type: str
+        """
+        self.directory = str(directory)
+        self.budget = budget
+        self.dirname = dirname
+        self.output = Output(self.directory)
+        self.folder = os.path.join(self.directory, dirname)
+        self.index_file = os.path.join(self.folder, '.derivative_cache.json')
+        self.entries = {}
+        self.hashes = {}
+        self._saved = 0
+        if isfile(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    index = json.load(f)
+                self.entries = index['entries']
+                self.hashes = index['hashes']
+            except (OSError, ValueError, KeyError):
+                print(f'Cache index {self.index_file} is unreadable and will be rebuilt')
+
+
+    def stage(self, name, func, *inputs, params=None, **kwargs):
+        """
+        Returns a lazy result of func(*inputs, **kwargs).
+
+        :param name: name of the processing stage, i.e. 'extract', 'df_f0', 'filter', 'correction', 'clustering'
+        :type: str
+        :param func: function computing the result
+        :type: callable
+        :param inputs: complete paths to files, results of other stages or numpy arrays
+        :type: str, CachedStage or numpy.ndarray
+        :param params: parameters of func that are not visible in kwargs, i.e. Filter.params for Filter.filter;
+        used for the key only
+        :type: dict
+        :param kwargs: keyword arguments of func; part of the key
+        :type: any
+
+        :return: the result, computed or loaded by CachedStage.load
+        :type: CachedStage
+        """
+        return CachedStage(self, name, func, inputs, params, kwargs)
+
+
+    def file_hash(self, filename):
+        """
+        Returns the blake2b hash of the content of a file. Hashes are remembered in the index
+        until the size or modification time of the file changes.
+
+        :param filename: complete path to file
+        :type: str
+
+        :return: hash of the file
+        :type: str
+        """
+        filename = os.path.abspath(str(filename))
+        stat = os.stat(filename)
+        known = self.hashes.get(filename)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        digest = hashlib.blake2b(digest_size=20)
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(2**24), b''):
+                digest.update(block)
+        self.hashes[filename] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        self.save()
+        return digest.hexdigest()
+
+
+    def lookup(self, key):
+        """
+        Returns the complete paths to the files of a cached result, or None if key is not cached.
+
+        :param key: key of the result, see CachedStage.key
+        :type: str
+
+        :return: complete paths to the files of the result
+        :type: list
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        paths = [os.path.join(self.folder, f) for f in entry['files']]
+        if not all(isfile(p) for p in paths):
+            del self.entries[key]
+            self.save()
+            return None
+        # The last use only orders eviction, so it is written with the next change of the index
+        entry['last_used'] = time.time()
+        if time.time() - self._saved > self.SAVE_INTERVAL:
+            self.save()
+        return paths
+
+
+    def store(self, key, name, result, f_in=None):
+        """
+        Saves a result with Output.saveas and evicts the least recently used results if the cache is over budget.
+        Tuples are saved one file per element so that each element can be loaded on its own.
+
+        :param key: key of the result, see CachedStage.key
+        :type: str
+        :param name: name of the processing stage
+        :type: str
+        :param result: the result
+        :type: numpy.ndarray or tuple
+        :param f_in: complete path to the raw file from which the result was derived
+        :type: str
+
+        :return: complete paths to the files of the result
+        :type: list
+        """
+        parts = result if isinstance(result, tuple) else (result,)
+        files = []
+        for i, part in enumerate(parts):
+            suffix = f'{name}_{key[:12]}' if len(parts) == 1 else f'{name}_{key[:12]}_{i}'
+            files.append(self.output.saveas(part, 'npy', suffix=suffix, f_in=f_in, save=True, dirname=self.dirname))
+        paths = [os.path.join(self.folder, f) for f in files]
+        self.entries[key] = {
+            'stage': name,
+            'files': files,
+            'tuple': isinstance(result, tuple),
+            'size': sum(getsize(p) for p in paths),
+            'last_used': time.time(),
+        }
+        self.evict(keep=key)
+        self.save()
+        return paths
+
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used results until the cache fits in its budget.
+
+        :param keep: key of a result that is never removed, i.e. the one just stored
+        :type: str
+        """
+        if self.budget is None:
+            return
+        total = sum(entry['size'] for entry in self.entries.values())
+        for key in sorted(self.entries, key=lambda k: self.entries[k]['last_used']):
+            if total <= self.budget:
+                break
+            if key == keep:
+                continue
+            entry = self.entries.pop(key)
+            for f in entry['files']:
+                try:
+                    os.remove(os.path.join(self.folder, f))
+                except FileNotFoundError:
+                    pass
+            total -= entry['size']
+            print(f'Removed {", ".join(entry["files"])} from cache')
+
+
+    def clear(self):
+        """
+        Removes all cached results.
+        """
+        budget, self.budget = self.budget, 0
+        self.evict()
+        self.budget = budget
+        self.save()
+
+
+    def save(self):
+        """
+        Writes the index to self.index_file, replacing the previous one atomically.
+        """
+        if isdir(self.folder) is False:
+            os.makedirs(self.folder)
+        tmp = self.index_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'entries': self.entries, 'hashes': self.hashes}, f)
+        os.replace(tmp, self.index_file)
+        self._saved = time.time()
+
+
+class CachedStage:
+    """
+    Lazy result of a DerivativeCache stage. Indexing a stage whose function returns a tuple,
+    i.e. cache.stage('df_f0', vp.calculate_df_f0, frames)[0], selects one element without loading the others.
+    """
+
+
+    def __init__(self, cache, name, func, inputs, params, kwargs, item=None):
+        self.cache = cache
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.params = params
+        self.kwargs = kwargs
+        self.item = item
+        self._key = None
+
+
+    def __getitem__(self, item):
+        return CachedStage(self.cache, self.name, self.func, self.inputs, self.params, self.kwargs, item)
+
+
+    @property
+    def key(self):
+        """
+        Hash of the stage name, the function, the keys of the inputs and the parameters.
+        Raises TypeError for parameters without a stable representation.
+        """
+        if self._key is None:
+            digest = hashlib.blake2b(digest_size=20)
+            digest.update(json.dumps({
+                'stage': self.name,
+                'func': _qualified_name(self.func),
+                'inputs': [self._input_key(i) for i in self.inputs],
+                'params': self.params or {},
+                'kwargs': self.kwargs,
+            }, sort_keys=True, default=_jsonable).encode())
+            self._key = digest.hexdigest()
+        return self._key if self.item is None else f'{self._key}/{self.item}'
+
+
+    @property
+    def source(self):
+        """
+        Complete path to the first file from which the result is derived, or None.
+        """
+        for i in self.inputs:
+            if isinstance(i, CachedStage):
+                if i.source is not None:
+                    return i.source
+            elif isinstance(i, (str, Path)):
+                return os.path.abspath(str(i))
+        return None
+
+
+    def load(self, mmap_mode=None):
+        """
+        Returns the result, loaded from the cache if it was computed before; otherwise the inputs are loaded,
+        the result is computed and cached.
+
+        :param mmap_mode: passed to numpy.load, i.e. 'r' to map the cached arrays instead of reading them
+        :type: str
+
+        :return: the result
+        :type: any
+        """
+        key = self.key.split('/')[0]
+        paths = self.cache.lookup(key)
+        if paths is None:
+            inputs = [i.load() if isinstance(i, CachedStage) else i for i in self.inputs]
+            result = self.func(*inputs, **self.kwargs)
+            paths = self.cache.store(key, self.name, result, f_in=self.source)
+            if self.item is None:
+                return result
+            return result[self.item]
+        if self.item is not None:
+            return _load_npy(paths[self.item], mmap_mode)
+        if self.cache.entries[key]['tuple'] is True:
+            return tuple(_load_npy(p, mmap_mode) for p in paths)
+        return _load_npy(paths[0], mmap_mode)
+
+
+    def _input_key(self, i):
+        if isinstance(i, CachedStage):
+            return 'stage:' + i.key
+        if isinstance(i, (str, Path)):
+            if isfile(i) is False:
+                raise FileNotFoundError(f'{i} does not exist')
+            return 'file:' + self.cache.file_hash(i)
+        i = np.ascontiguousarray(i)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f'{i.dtype.str}{i.shape}'.encode())
+        digest.update(i.data)
+        return 'array:' + digest.hexdigest()
+
+
+def _qualified_name(func):
+    # Functions and methods in the cache keys, i.e. 'video_processing.Filter.filter'
+    name = getattr(func, '__qualname__', None)
+    if name is None or '<lambda>' in name or '<locals>' in name:
+        raise TypeError(f'{func!r} has no stable name to cache its results under; use a module-level function')
+    return f'{func.__module__}.{name}'
+
+
+def _jsonable(value):
+    # Parameters such as numpy scalars, arrays, dtypes and tuples of arrays in the cache keys
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.dtype):
+        return value.str
+    if isinstance(value, type):
+        return _qualified_name(value)
+    if isinstance(value, Path):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f'{value!r} cannot be part of a cache key; pass it as a plain value or in params')
+
+
+def _load_npy(path, mmap_mode=None):
+    result = np.load(path, mmap_mode=mmap_mode, allow_pickle=True)
+    if result.dtype == object and result.ndim == 0:
+        return result.item()
+    return result
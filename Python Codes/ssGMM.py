@@ -41,59 +41,33 @@ def ss_GaussianMixtureModels(Xtrain, ytrain, Xtest, beta, tol, max_iterations, e
     
     from sklearn.metrics import accuracy_score
     import numpy as np
-    from scipy.stats import pearsonr
-    from itertools import product
+    from scipy.special import logsumexp
     
     
     ## Custom designed Gaussian Naive Bayes classifier that outputs pi, mu, sigma
     def Bayes(X, y):
         (n, d) = np.shape(X)
-        uniq = np.unique(y)
+        y = np.ravel(y)
+        uniq, labels, counts = np.unique(y, return_inverse=True, return_counts=True)
         ####################################################################
         ####          SOLVING FOR THE CLASS PRIOR PROBABILITY          #####
         ####################################################################
-        pi = []
-        for j in uniq:
-            sum = 0
-            for i in range(0,n,1):
-                if y[i] == j:
-                    sum += 1
-            pi.append(sum/n)     
+        pi = counts/n
         
         ####################################################################
         ####       SOLVING FOR THE CLASS SPECIFIC GAUSSIAN MEAN         ####
         ####################################################################
-        mu_y = np.zeros((len(uniq),d))
-        for j in range(0,len(uniq),1):
-            sum = 0
-            counter = 0
-            for i in range(0,n,1):
-                if np.mean(y[i]) == np.mean(uniq[j]):
-                    sum = sum + X[i,:]
-                    counter += 1
-            mu_y[j,:] = (1/counter)*sum
+        onehot = np.zeros((n, len(uniq)))
+        onehot[np.arange(n), labels] = 1.0
+        mu_y = np.matmul(onehot.T, X)/counts[:,None]
         
         ####################################################################
         ####     SOLVING FOR THE CLASS SPECIFIC GAUSSAIN COVARIANCE    #####
         ####################################################################
-        sigma_dic = {}
-        for i in uniq:
-            sigma_dic["SIGMA_K_" + str(i)] = np.eye(d)
-        #Access an entry in the dictionary using a string key as follows:
-        #sigma_ID = "SIGMA_K_" + str(j)
-        #sigma_dic[sigma_ID]
-        
-        for j in range(0,len(uniq),1):
-            sum = 0
-            counter = 0
-            sigma_ID = "SIGMA_K_" + str(uniq[j])
-            for i in range(0,n,1):
-                if y[i] == uniq[j]:
-                    sum = sum + np.outer(np.transpose(X[i,:] - mu_y[j,:]),(X[i,:] - mu_y[j,:]))
-                    counter += 1
-            sigma_dic[sigma_ID] = (1/counter)*sum
+        centered = X - mu_y[labels]
+        sigma = np.einsum('nk,ni,nj->kij', onehot, centered, centered, optimize=True)/counts[:,None,None]
     
-        return pi, mu_y, sigma_dic
+        return pi, mu_y, sigma
     
     ###########################################################################
     ###########################################################################
@@ -105,7 +79,6 @@ def ss_GaussianMixtureModels(Xtrain, ytrain, Xtest, beta, tol, max_iterations, e
     L = np.size(ytrain) #%%% EQUATION 1 %%%#
     uniq = np.unique(ytrain)
     K = len(uniq) # The number of classes
-    uniq = uniq.tolist()
     Xtrain = np.hstack((Xtrain, np.ones((L,1))))
     U = np.size(Xtest[:,0]) #%%% EQUATION 2 %%%#
     print('Number of labeled data: ' + str(L))
@@ -114,70 +87,70 @@ def ss_GaussianMixtureModels(Xtrain, ytrain, Xtest, beta, tol, max_iterations, e
     Xtest = np.hstack((Xtest, np.ones((U,1))))
     D = np.vstack((Xtrain, Xtest)) #%%% EQUATION 4 %%%#
     (n, d) = np.shape(D)
+    # Class index of every labeled data point
+    ylabel = np.searchsorted(uniq, np.ravel(ytrain))
+    # Weight of each data point in the M-step: beta for labeled, (1-beta) for unlabeled
+    sample_weight = np.concatenate((np.full(L, beta), np.full(U, 1 - beta)))
     
     # ssGMM needs starting values for the Gaussian means & covariances for each class, so a Bayes classifier on the LABELED data is used to determine these
     pi, mu, sigma = Bayes(Xtrain, ytrain) #%%% EQUATION 8 %%%#
     
     
     #### Using a limited number of training data can cause the covariance matrices of the resulting classes 
-    #### to be singular. The code below uses an SVD decomposition to compute the determinant and the inverse
-    #### of the covariance matrices. These are needed to compute probability density function. 
-    sigma_inv = {}
-    det_sigma = []
-    
-    for j in range(0,len(uniq),1):
-        sigma_ID = "SIGMA_K_" + str(uniq[j])
-        
-        [u, s, v] = np.linalg.svd(sigma[sigma_ID])
-        rank = len(s[s > cond_tolerance])
-        det_sigma.append(np.prod(s[:rank]))
+    #### to be singular. The code below uses an eigendecomposition of the (symmetric) covariance matrices
+    #### to compute their pseudo-determinant and pseudo-inverse, exactly as an SVD would. These are needed
+    #### to compute the probability density function.
+    def decompose(sigma):
         try:
-        # Code that will (maybe) throw an exception
-            sigma_inv[sigma_ID] = np.linalg.pinv(sigma[sigma_ID], rcond = cond_tolerance)
-            #det_sigma.append(np.linalg.det(sigma[sigma_ID]))
+            eigval, eigvec = np.linalg.eigh(sigma)
         except np.linalg.LinAlgError:
-            print("The covariance matrix associated with Class " + str(uniq[j]) + " is still SINGULAR")
-            sigma_inv[sigma_ID] = np.linalg.inv(sigma[sigma_ID], rcond = cond_tolerance)
-        except:
-            print("Unexpected error")
-            raise 
+            print("The covariance matrices could not be decomposed")
+            raise
+        s = np.abs(eigval) # singular values of a symmetric matrix
+        # Pseudo-determinant: product of the singular values above cond_tolerance
+        log_det_sigma = np.sum(np.where(s > cond_tolerance, np.log(np.where(s > 0, s, 1)), 0), axis=1)
+        # Pseudo-inverse: singular values below rcond*max(s) are discarded, as in np.linalg.pinv
+        keep = s > cond_tolerance*np.max(s, axis=1, keepdims=True)
+        inv_eigval = np.where(keep, 1/np.where(keep, eigval, 1), 0)
+        return log_det_sigma, eigvec, inv_eigval
+    
+    log_det_sigma, eigvec, inv_eigval = decompose(sigma)
                 
     ###########################################################################            
     #########   MULTI-VARIATE GAUSSIAN PROBABILITY DENSITY FUNCTION   #########
     ###########################################################################
-    # For the EM algorithm below, the objective function has to be computed MANY times, and the built in function (scipy.stats.multivariate_normal.pdf) recomputes the covariance matrix inverses/determinants, which is computationally inefficient.
-    # This function below incorporates the pre-computed covariance matrix inverses and covariance determinants, and this drastically improves the computation time (5-6x faster)
-    
-    def gaussian_PDF(x,mu,sigma,det_sigma,sigma_inv):
-        return (1/np.sqrt((2*np.pi)**(d)*det_sigma))*np.exp(-0.5*np.matmul((x-mu).T, np.matmul(sigma_inv, (x-mu))))
+    # Log-densities of every data point under every class, shape (n, K). Each class needs one
+    # matrix product of the centered data with the eigenvectors of its covariance matrix.
+    # Working with logarithms avoids the underflow of the densities in high dimensions.
+    
+    def log_gaussian_PDF(D, mu, log_det_sigma, eigvec, inv_eigval):
+        log_pdf = np.empty((np.shape(D)[0], K))
+        for j in range(0,K,1):
+            projected = np.matmul(D - mu[j,:], eigvec[j])
+            mahalanobis = np.matmul(projected**2, inv_eigval[j])
+            log_pdf[:,j] = -0.5*(d*np.log(2*np.pi) + log_det_sigma[j] + mahalanobis)
+        return log_pdf
         
     ###########################################################################
     ###################   OBJECTIVE FUNCTION FOR ssGMM   ######################
     ###################            Equation 7            ######################
     ###########################################################################
 
-    def objective_func(L, U, D, ytrain, pi, mu, sigma, det_sigma, sigma_inv): 
-        sum_label = 0
+    def objective_func(log_joint): 
         ## FOR THE LABELED PART OF THE OBJECTIVE FUNCTION
-        for i in range(0,L,1):
-            sigma_ID = "SIGMA_K_" + str(int(ytrain[i]))
-            ind = uniq.index(ytrain[i])
-            sum_label = sum_label + np.log(pi[ind]*gaussian_PDF(D[i,:], mu[ind,:], sigma[sigma_ID], det_sigma[ind], sigma_inv[sigma_ID]))
+        sum_label = np.sum(log_joint[np.arange(L), ylabel])
 
         ## FOR THE UNLABELED PART OF THE OBJECTIVE FUNCTION     
-        sum_noLabel = 0
-        for i in range(L,L+U,1):
-            inner_sum = 0
-            for j in range(0,len(uniq),1):
-                sigma_ID = "SIGMA_K_" + str(uniq[j])
-                inner_sum = inner_sum + pi[j]*gaussian_PDF(D[i,:], mu[j,:], sigma[sigma_ID], det_sigma[j], sigma_inv[sigma_ID])
-            sum_noLabel = sum_noLabel + np.log(inner_sum)
+        sum_noLabel = np.sum(logsumexp(log_joint[L:,:], axis=1))
 
         return beta*sum_label + (1-beta)*sum_noLabel
     
+    with np.errstate(divide='ignore'):
+        log_joint = np.log(pi) + log_gaussian_PDF(D, mu, log_det_sigma, eigvec, inv_eigval)
+    
     Objective = []
     # This is the starting objective function value
-    Objective.append(objective_func(L, U, D, ytrain, pi, mu, sigma, det_sigma, sigma_inv))    
+    Objective.append(objective_func(log_joint))    
     
     GAMMA = np.zeros((n,K))
     obj_change = tol + 1
@@ -193,81 +166,43 @@ def ss_GaussianMixtureModels(Xtrain, ytrain, Xtest, beta, tol, max_iterations, e
         ##########################
         ######## E-STEP ##########
         ##########################
-        for i in range(0,n,1):
         #%%% EQUATION 9 %%%#
-            ## For LABELED instances
-            if i < L:
-                for j in range(0,len(uniq),1):
-                    if ytrain[i] == uniq[j]:
-                        GAMMA[i,j] = 1.0
-            
-            ## For UNLABELED instances
-            else:
-                sum = 0
-                for j in range(0,len(uniq),1):
-                    sigma_ID = "SIGMA_K_" + str(uniq[j])
-                    GAMMA[i,j] = pi[j]*gaussian_PDF(D[i,:], mu[j,:], sigma[sigma_ID], det_sigma[j], sigma_inv[sigma_ID])
-                    sum = sum + GAMMA[i,j]
-                GAMMA[i,:] = (1/sum)*GAMMA[i,:]
+        ## For LABELED instances
+        GAMMA[np.arange(L), ylabel] = 1.0
+        
+        ## For UNLABELED instances
+        GAMMA[L:,:] = np.exp(log_joint[L:,:] - logsumexp(log_joint[L:,:], axis=1, keepdims=True))
         
         
         ##########################
         ######## M-STEP ##########
         ##########################
-        
-        for j in range(0,len(uniq),1):
         #%%% EQUATIONS FROM STEP 3 %%%#    
-            nl = 0
-            nu = 0
-            for i in range(0,L,1):
-                nl = nl + GAMMA[i,j]
-            for i in range(L,L+U,1):
-                nu = nu + GAMMA[i,j]
-            C = (beta*nl + (1-beta)*nu) #this is a factor that is common in each of the three parameters below
+        weights = sample_weight[:,None]*GAMMA
+        C = np.sum(weights, axis=0) #this is a factor that is common in each of the three parameters below
 
-            #### Updating the cluster prior probabilities, pi ####          
-            pi[j] = (C)/(beta*L + (1-beta)*U)
-            
-            #### Updating the cluster means, mu ####
-            mean_sumL = 0
-            mean_sumU = 0
-            for i in range(0,L,1):
-                mean_sumL = mean_sumL + GAMMA[i,j]*D[i,:]
-            for i in range(L,L+U,1):
-                mean_sumU = mean_sumU + GAMMA[i,j]*D[i,:]       
-            mu[j,:] = (beta*mean_sumL + (1-beta)*mean_sumU)/(C)
-            
-            #### Updating the cluster covariance matrices, sigma ####
-            sigma_ID = "SIGMA_K_" + str(uniq[j])
-            
-            sigma_sumL = 0
-            sigma_sumU = 0
-            for i in range(0,L,1):
-                sigma_sumL = sigma_sumL + GAMMA[i,j]*np.outer(np.transpose(D[i,:] - mu[j,:]),(D[i,:] - mu[j,:]))
-            for i in range(L,L+U,1):
-                sigma_sumU = sigma_sumU + GAMMA[i,j]*np.outer(np.transpose(D[i,:] - mu[j,:]),(D[i,:] - mu[j,:]))
-            
-            sigma[sigma_ID] = (beta*sigma_sumL + (1-beta)*sigma_sumU)/(C)
-            
-            #### Updating the covariance matrix determinants and covariance inverses ####
-            try: # Code that will (maybe) throw an exception
-                sigma_inv[sigma_ID] = np.linalg.pinv(sigma[sigma_ID], rcond = cond_tolerance)
-                [u, s, v] = np.linalg.svd(sigma[sigma_ID])
-                rank = len(s[s>cond_tolerance])
-                det_sigma[j] = np.prod(s[:rank])
-            except np.linalg.LinAlgError:
-                #print("The covariance matrix associated with Class " + str(uniq[j]) + " has singular values, so its determinant and inverse has issues")
-                sigma_inv[sigma_ID] = np.linalg.inv(sigma[sigma_ID])
-            except:
-                print("Unexpected error")
-                raise 
+        #### Updating the cluster prior probabilities, pi ####          
+        pi = C/(beta*L + (1-beta)*U)
+        
+        #### Updating the cluster means, mu ####
+        mu = np.matmul(weights.T, D)/C[:,None]
+        
+        #### Updating the cluster covariance matrices, sigma ####
+        centered = D[:,None,:] - mu[None,:,:]
+        sigma = np.einsum('nk,nki,nkj->kij', weights, centered, centered, optimize=True)/C[:,None,None]
+        del centered
+        
+        #### Updating the covariance matrix determinants and covariance inverses ####
+        log_det_sigma, eigvec, inv_eigval = decompose(sigma)
             
             
         ##############################################################
         ######## Compute Objective Function: Log-likelihood ##########
         ##############################################################
         
-        Objective.append(objective_func(L, U, D, ytrain, pi, mu, sigma, det_sigma, sigma_inv))        
+        with np.errstate(divide='ignore'):
+            log_joint = np.log(pi) + log_gaussian_PDF(D, mu, log_det_sigma, eigvec, inv_eigval)
+        Objective.append(objective_func(log_joint))        
         
         ## The early stopping criteria
         if early_stop == 'True': 
@@ -287,13 +222,8 @@ def ss_GaussianMixtureModels(Xtrain, ytrain, Xtest, beta, tol, max_iterations, e
     #print("The objective function: \n", Objective)
     
     ## Using a threshold to assign labels to the unlabeled points with the highest probability
-    GMM_label_pred = np.ones(U)*99.99
-    k = 0
-    for i in range(L,L+U,1):
-        #%%% EQUATION 10 %%%#
-        cl = GAMMA[i,:].argmax()
-        GMM_label_pred[k] = uniq[cl]
-        k = k + 1
+    #%%% EQUATION 10 %%%#
+    GMM_label_pred = uniq[GAMMA[L:(L+U),:].argmax(axis=1)].astype(float)
         
     #semi_GMM_accuracy = accuracy_score(ytest, GMM_label_pred)
     #print("Standard accuracy metric of Semi-supervised GMM using beta = " + str(beta) + ", and tol = " + str(tol) + ": " + str(semi_GMM_accuracy))
@@ -0,0 +1,163 @@
+"""
+Tests of the capture pipeline of high_speed_camera_LabJack.py, driven by SimulatedCamera and
+MockLabJack so that they run without the camera SDK or a LabJack.
+
+Usage:
+    python -m pytest "Python Codes/test_high_speed_camera_LabJack.py"
+"""
+
+import time
+
+import numpy as np
+
+import high_speed_camera_LabJack as hs
+import video_processing as vp
+
+
+class CountingCamera(hs.SimulatedCamera):
+    """
+    SimulatedCamera counting the frames it delivers
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.produced = 0
+
+    def grab(self, out):
+        result = super().grab(out)
+        if result is not None:
+            self.produced += 1
+        return result
+
+
+def stall_writer(pipeline, at, seconds):
+    # Hold the writer thread at the given frame counts so that the ring fills up
+    write = pipeline.writer.write
+
+    def slow_write(frame, timestamp):
+        if pipeline.writer.frame_count in at:
+            time.sleep(seconds)
+        write(frame, timestamp)
+
+    pipeline.writer.write = slow_write
+
+
+def test_capture_pipeline_counts_drops(tmp_path):
+    fps = 300
+    camera = CountingCamera(64, 48, fps, drop_every=50)
+    pipeline = hs.CapturePipeline(camera, str(tmp_path / "cam.avi"), fps, capacity=32,
+                                  segment_frames=250)
+    stall_writer(pipeline, at=(100, 300), seconds=0.3)
+    stats = pipeline.run(600)
+
+    # Every frame delivered by the camera is either in the ring or dropped, and logged
+    assert stats["grabbed"] + stats["dropped"] == camera.produced
+    assert stats["dropped"] > 0
+    assert stats["occupancy"] == 0
+    assert stats["high_water"] == 32
+    records = hs.TimestampLog.load(str(tmp_path / "cam-timestamp.npy"))
+    assert stats["logged"] == len(records) == camera.produced
+    assert np.count_nonzero(records["written"] == 0) == stats["dropped"]
+
+    # The video holds the positions VideoClock gives the frames that reached the writer
+    clock = hs.VideoClock(fps)
+    positions = [clock.advance(t) for t in records["device_ns"][records["written"] == 1]]
+    assert stats["written"] == positions[-1] + 1
+    frames = vp.load_frames(str(tmp_path / "cam-manifest.json"), False)
+    assert len(frames) == stats["written"]
+    assert len(vp.load_behaviour_timestamps(str(tmp_path / "cam-timestamp.npy"))) == len(frames)
+
+
+def test_raw_timestamps_read_as_imaging_timestamps(tmp_path):
+    fps = 300
+    pipeline = hs.CapturePipeline(
+        hs.SimulatedCamera(64, 48, fps, drop_every=50), str(tmp_path / "cam.avi"), fps)
+    pipeline.run(600)
+
+    timestamps = vp.clean_raw_timestamps(str(tmp_path / "cam-timestamp.raw"))
+    # Element 0 is the placeholder overwritten by clean_raw_timestamps
+    assert len(timestamps) == pipeline.log.count + 1
+    assert np.all(np.diff(timestamps) > 0)
+
+    # Microseconds: the camera skips every 50th frame, which shows as a gap of two periods
+    frame_ids = hs.TimestampLog.load(str(tmp_path / "cam-timestamp.npy"))["frame_id"]
+    _, locations = vp.get_locations_of_dropped_frames(timestamps[1:], 1.5e6 / fps)
+    assert np.array_equal(locations, np.flatnonzero(np.diff(frame_ids) > 1))
+
+
+def test_schedule_cpus():
+    schedule = hs.schedule_cpus(2, n_cpus=8)
+    # Each grab thread has a CPU of its own, which no other thread uses
+    assert [cpus["grab"] for cpus in schedule] == [[0], [1]]
+    for cpus in schedule:
+        assert not set(cpus["writer"]) & {0, 1}
+        assert not set(cpus["log"]) & {0, 1}
+    assert not set(schedule[0]["writer"]) & set(schedule[1]["writer"])
+    # Without two CPUs per camera the threads are left to the operating system
+    assert hs.schedule_cpus(2, n_cpus=3) == [{}, {}]
+
+
+def test_multi_camera_recorder(tmp_path):
+    fps = 300
+    cameras = [CountingCamera(64, 48, fps, drop_every=50), CountingCamera(64, 48, fps)]
+    names = ("whisker", "limb")
+    trigger = hs.LabJackTrigger(hs.MockLabJack(delay=0.05))
+    recorder = hs.MultiCameraRecorder(
+        cameras, [str(tmp_path / f"{name}.avi") for name in names], fps, trigger=trigger,
+        segment_frames=250)
+    stats = recorder.run(600, timeout=5)
+    metadata = recorder.metadata()
+
+    assert metadata["trigger_edge_ns"] == recorder.edge_ns
+    for name, camera, camera_stats, camera_metadata in zip(
+            names, cameras, stats, metadata["cameras"]):
+        assert camera_stats["dropped"] == 0
+        # Both cameras start from the one trigger, within the first frame periods
+        assert 0 < camera_metadata["trigger_to_first_frame_ns"] < 0.1e9
+
+        manifest = vp.VideoSession(str(tmp_path / f"{name}-manifest.json"))
+        assert manifest.manifest["complete"] is True
+        assert [(s["start"], s["stop"]) for s in manifest.segments] == [
+            (start, min(start + 250, camera_stats["written"]))
+            for start in range(0, camera_stats["written"], 250)
+        ]
+        assert all((tmp_path / s["file"]).is_file() for s in manifest.segments)
+
+        # The log and the .raw file hold one entry per frame the camera delivered (after the
+        # placeholder of the .raw file); the video holds one frame per position of the frame
+        # ids, the frames the camera skipped being filled by repeats. With drop_every=50 the
+        # camera delivers 589 frames with ids 0-600, and the video has 601 frames.
+        records = hs.TimestampLog.load(str(tmp_path / f"{name}-timestamp.npy"))
+        raw = np.fromfile(str(tmp_path / f"{name}-timestamp.raw"), dtype=np.float32)
+        assert len(records) == len(raw) - 1 == camera.produced
+        assert camera_stats["written"] == len(manifest) == records["frame_id"][-1] + 1
+    assert cameras[0].produced == 589 and stats[0]["written"] == 601
+    assert cameras[1].produced == 600 and stats[1]["written"] == 600
+
+
+def test_trigger_poll_error_within_poll_interval():
+    poll_interval = 0.002
+    for _ in range(5):
+        device = hs.MockLabJack(delay=0.02, usb_latency=0.0001)
+        trigger = hs.LabJackTrigger(device, poll_interval=poll_interval)
+        error_ns = abs(trigger.wait(timeout=1) - device.edge_ns)
+        assert error_ns <= trigger.uncertainty_ns
+        assert error_ns <= poll_interval * 1e9
+    result = hs.benchmark_trigger(
+        n_trials=5, delay=0.02, poll_interval=poll_interval)
+    assert abs(result["error_us"]) <= poll_interval * 1e6
+    assert result["reads"] > 1
+
+
+def test_trigger_stream_error_within_scan_period():
+    scan_frequency = 10000
+    period_ns = 1e9 / scan_frequency
+    for _ in range(5):
+        device = hs.MockLabJack(delay=0.02)
+        trigger = hs.LabJackTrigger(device, stream=True, scan_frequency=scan_frequency)
+        error_ns = abs(trigger.wait(timeout=1) - device.edge_ns)
+        assert error_ns <= period_ns
+        assert trigger.uncertainty_ns == round(period_ns)
+    result = hs.benchmark_trigger(
+        n_trials=5, delay=0.02, stream=True, scan_frequency=scan_frequency)
+    assert abs(result["error_us"]) <= period_ns / 1e3
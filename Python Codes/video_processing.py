@@ -1,13 +1,75 @@
 
+import bisect
+import json
+import os
+
 import numpy
 from joblib import cpu_count, delayed, Parallel
-from scipy import signal
+from scipy import ndimage, signal
 from sklearn.utils import gen_even_slices
 import cv2
 import pandas
 import matplotlib.pyplot as plt
+from matplotlib.path import Path
 from roipoly import RoiPoly
 
+def _raw_frame_count(filename, width, height, datatype, num_channels):
+    """
+    Number of frames stored in an interleaved .RAW file, derived from its size
+
+    :param filename: name of .RAW file containing image data
+    :type: str
+    :param width: width of data
+    :type: int
+    :param height: height of data
+    :type: int
+    :param datatype: numpy datatype of the samples
+    :type: numpy.dtype
+    :param num_channels: number of interleaved channels per pixel
+    :type: int
+
+    :return: number of frames
+    :type: int
+    """
+    n_items = os.path.getsize(filename) / numpy.dtype(datatype).itemsize
+    time_dim_float = n_items / (width * height * num_channels)
+    time_dim = int(time_dim_float)
+    if time_dim != time_dim_float:
+        raise Exception(
+            "Invalid input file or arguments"
+        )
+    return time_dim
+
+
+def _frame_range(frame_slice, time_dim):
+    """
+    Bounds of a contiguous slice of frames, clipped to the number of frames
+    """
+    start, stop, step = frame_slice.indices(time_dim)
+    if step != 1:
+        raise ValueError("Argument `frame_slice` must have a step of 1")
+    return start, max(start, stop)
+
+
+def _read_RAW_range(filename, width, height, datatype, num_channels, frame_slice):
+    """
+    Read only the frames of frame_slice from an interleaved .RAW file
+    """
+    time_dim = _raw_frame_count(filename, width, height, datatype, num_channels)
+    start, stop = _frame_range(frame_slice, time_dim)
+    frame_items = width * height * num_channels
+    raw_frames = numpy.fromfile(
+        filename,
+        dtype=datatype,
+        count=(stop - start) * frame_items,
+        offset=start * frame_items * numpy.dtype(datatype).itemsize,
+    )
+    shape = (stop - start, height, width)
+    if num_channels == 3:
+        shape = shape + (3,)
+    return raw_frames.reshape(shape)
+
+
 def extract_RAW_frames(
     filename,
     width,
@@ -15,6 +77,8 @@ def extract_RAW_frames(
     channel="all",
     dtype="uint8",
     num_channels=3,
+    mmap=False,
+    frame_slice=None,
 ):
     """
    Extract channels from .RAW file containing image data
@@ -31,9 +95,16 @@ def extract_RAW_frames(
    :type: optional str
    :param num_channels, one of (1,3). defualt is 3
    :type: optional int
+   :param mmap: if True, memory-map the file read-only instead of loading it. A single
+                channel is then returned as a strided view on the mapping, so no frame
+                is read from disk until it is accessed. default is False
+   :type: optional bool
+   :param frame_slice: contiguous range of frames to read, i.e. from DarkFramesSlice.raw_slice;
+                the other frames are never read. default is all frames
+   :type: optional slice
 
    :return: channel(s) extracted from .RAW file
-   :type: numpy.ndarray
+   :type: numpy.ndarray or numpy.memmap
    """
     if num_channels not in (1, 3):
         raise AttributeError(
@@ -45,28 +116,45 @@ def extract_RAW_frames(
         raise AttributeError(
             f"dtype numpy.{dtype} does not exist"
         )
-    if num_channels is 3:
+    if num_channels == 3:
         if channel not in ("all", "red", "blue", "green"):
             raise AttributeError(
                 "Keyword 'channel' must be one of: ('all', 'red', 'blue', 'green')"
             )
-        with open(filename, "rb") as file:
-            raw_frames = numpy.fromfile(
-                file, dtype=datatype
+        if mmap:
+            time_dim = _raw_frame_count(
+                filename, width, height, datatype, 3
             )
-        print(raw_frames.shape)
-        time_dim_float = raw_frames.shape[0] / (
-            width * height * 3
-        )
-        print(time_dim_float)
-        time_dim = int(time_dim_float)
-        if time_dim != time_dim_float:
-            raise Exception(
-                "Invalid input file or arguments"
+            raw_frames = numpy.memmap(
+                filename,
+                dtype=datatype,
+                mode="r",
+                shape=(time_dim, height, width, 3),
+            )
+            if frame_slice is not None:
+                raw_frames = raw_frames[slice(*_frame_range(frame_slice, time_dim))]
+        elif frame_slice is not None:
+            raw_frames = _read_RAW_range(
+                filename, width, height, datatype, 3, frame_slice
+            )
+        else:
+            with open(filename, "rb") as file:
+                raw_frames = numpy.fromfile(
+                    file, dtype=datatype
+                )
+            print(raw_frames.shape)
+            time_dim_float = raw_frames.shape[0] / (
+                width * height * 3
+            )
+            print(time_dim_float)
+            time_dim = int(time_dim_float)
+            if time_dim != time_dim_float:
+                raise Exception(
+                    "Invalid input file or arguments"
+                )
+            raw_frames = numpy.reshape(
+                raw_frames, (time_dim, height, width, 3)
             )
-        raw_frames = numpy.reshape(
-            raw_frames, (time_dim, height, width, 3)
-        )
 
         channel = {"red": 0, "green": 1, "blue": 2}.get(
             channel
@@ -79,6 +167,23 @@ def extract_RAW_frames(
             return raw_frames[..., channel]
     else:
         # num_channels is 1
+        if mmap:
+            time_dim = _raw_frame_count(
+                filename, width, height, datatype, 1
+            )
+            raw_frames = numpy.memmap(
+                filename,
+                dtype=datatype,
+                mode="r",
+                shape=(time_dim, height, width),
+            )
+            if frame_slice is not None:
+                raw_frames = raw_frames[slice(*_frame_range(frame_slice, time_dim))]
+            return raw_frames
+        if frame_slice is not None:
+            return _read_RAW_range(
+                filename, width, height, datatype, 1, frame_slice
+            )
         with open(filename, "rb") as file:
             raw_frames = numpy.fromfile(
                 file, dtype=datatype
@@ -97,6 +202,82 @@ def extract_RAW_frames(
             return raw_frames
 
 
+def extract_RAW_channels(
+    filename,
+    width,
+    height,
+    channels=("green", "blue"),
+    dtype="uint8",
+    mmap=False,
+    block_size=256,
+    frame_slice=None,
+):
+    """
+    Extract several channels from an RGB .RAW file in a single pass
+
+    :param filename: name of .RAW file containing image data
+    :type: str
+    :param width: width of data
+    :type: int
+    :param height: height of data
+    :type: int
+    :param channels: names of channels to extract, each one of ('red', 'green', 'blue')
+    :type: optional tuple of str. default is ('green', 'blue')
+    :param dtype: numpy datatype. default is 'uint8'
+    :type: optional str
+    :param mmap: if True, return strided views on one read-only memory map of the file
+    :type: optional bool
+    :param block_size: number of frames read from disk at a time when mmap is False
+    :type: optional int>0
+    :param frame_slice: contiguous range of frames to read, i.e. from DarkFramesSlice.raw_slice;
+    the other frames are never read. default is all frames
+    :type: optional slice
+
+    :return: one (frames, height, width) array per requested channel, in order
+    :type: tuple of numpy.ndarray
+    """
+    indices = []
+    for channel in channels:
+        index = {"red": 0, "green": 1, "blue": 2}.get(channel)
+        if index is None:
+            raise AttributeError(
+                "Keyword 'channels' must only contain: ('red', 'blue', 'green')"
+            )
+        indices.append(index)
+    if mmap:
+        raw_frames = extract_RAW_frames(
+            filename, width, height, dtype=dtype, mmap=True,
+            frame_slice=frame_slice,
+        )
+        return tuple(raw_frames[..., index] for index in indices)
+
+    try:
+        datatype = getattr(numpy, dtype)
+    except AttributeError:
+        raise AttributeError(
+            f"dtype numpy.{dtype} does not exist"
+        )
+    time_dim = _raw_frame_count(filename, width, height, datatype, 3)
+    first, last = 0, time_dim
+    if frame_slice is not None:
+        first, last = _frame_range(frame_slice, time_dim)
+    outputs = tuple(
+        numpy.empty((last - first, height, width), dtype=datatype)
+        for _ in indices
+    )
+    frame_items = width * height * 3
+    with open(filename, "rb") as file:
+        file.seek(first * frame_items * numpy.dtype(datatype).itemsize)
+        for start in range(first, last, block_size):
+            stop = min(start + block_size, last)
+            block = numpy.fromfile(
+                file, dtype=datatype, count=(stop - start) * frame_items
+            ).reshape(stop - start, height, width, 3)
+            for output, index in zip(outputs, indices):
+                output[start - first:stop - first] = block[..., index]
+    return outputs
+
+
 def clean_raw_timestamps(filename):
     """
     Perform cleaning routine on .RAW timestamps
@@ -252,10 +433,14 @@ class DroppedFrames:
             ),
             dtype=numpy.float32,
         )
-        for frame_index in range(self.num_dropped_frames):
-            interpolated_frames[frame_index] = (
-                frame_index + 1
-            ) * diff_per_frame + self.first_frame
+        steps = numpy.arange(
+            1, self.num_dropped_frames + 1, dtype=numpy.float32
+        )
+        numpy.add(
+            steps[:, None, None] * diff_per_frame,
+            self.first_frame,
+            out=interpolated_frames,
+        )
         del self.first_frame
         del self.last_frame
         self.interpolated_frames = interpolated_frames
@@ -291,144 +476,557 @@ def insert_interpolated_frames(
     return frames
 
 
+def repair_dropped_frames(
+    frames, differences, locations, true_frame_rate, out=None, dtype=None, block_size=256
+):
+    """
+    Fill in dropped frames by linear interpolation in a single allocation.
+    Equivalent to generate_frames -> DroppedFrames.interpolate -> insert_interpolated_frames,
+    but every output position is computed up front so that the real frames are copied
+    once and the interpolated frames are filled by broadcasting.
+
+    :param frames: frames of channel extracted from RAW file
+    :type: numpy.ndarray
+    :param differences: differences between timestamps, from get_locations_of_dropped_frames
+    :type: numpy.ndarray
+    :param locations: indices of timestamps where frames were dropped, from get_locations_of_dropped_frames
+    :type: numpy.ndarray
+    :param true_frame_rate: true frame rate of footage
+    :type: float
+    :param out: array to write the repaired frames to, i.e. a numpy.memmap; allocated if None.
+    Its length must be len(frames) plus the number of dropped frames
+    :type: None or numpy.ndarray
+    :param dtype: datatype of the allocated output. default is the datatype of frames
+    :type: None or str or numpy.dtype
+    :param block_size: maximum number of interpolated frames computed at a time
+    :type: int>0
+
+    :return: array of frames with dropped frames filled
+    :type: numpy.ndarray
+    """
+    n_frames = frames.shape[0]
+    locations = numpy.asarray(locations, dtype=numpy.int64)
+    # A gap needs a frame on both sides to be interpolated
+    locations = locations[locations + 1 < n_frames]
+    num_dropped = (
+        numpy.round(
+            numpy.asarray(differences)[locations] / (1.0e6 / true_frame_rate)
+        ).astype(numpy.int64)
+        - 1
+    )
+    locations, num_dropped = locations[num_dropped > 0], num_dropped[num_dropped > 0]
+
+    # Output position of every real frame
+    shifts = numpy.zeros(n_frames, dtype=numpy.int64)
+    shifts[locations + 1] = num_dropped
+    real_positions = numpy.arange(n_frames) + numpy.cumsum(shifts)
+    n_total = n_frames + int(num_dropped.sum())
+
+    if out is None:
+        out = numpy.empty(
+            (n_total,) + frames.shape[1:],
+            dtype=frames.dtype if dtype is None else dtype,
+        )
+    elif out.shape[0] != n_total:
+        raise ValueError(
+            f"Argument `out` should have {n_total} frames, {out.shape[0]} given instead"
+        )
+    out[real_positions] = frames
+
+    # Gap index and interpolation weight of every missing frame
+    gaps = numpy.repeat(numpy.arange(locations.shape[0]), num_dropped)
+    steps = numpy.arange(gaps.shape[0]) - numpy.repeat(
+        numpy.cumsum(num_dropped) - num_dropped, num_dropped
+    ) + 1
+    weights = (steps / (num_dropped[gaps] + 1)).astype(numpy.float32)
+    positions = real_positions[locations[gaps]] + steps
+
+    for start in range(0, gaps.shape[0], block_size):
+        block = slice(start, start + block_size)
+        first = frames[locations[gaps[block]]].astype(numpy.float32)
+        last = frames[locations[gaps[block]] + 1].astype(numpy.float32)
+        weight = weights[block].reshape((-1,) + (1,) * (frames.ndim - 1))
+        out[positions[block]] = first + weight * (last - first)
+    return out
+
+
 class DarkFramesSlice:
     @staticmethod
-    def threshold_method(frames, threshold=4):
+    def frame_means(frames, spacetime=False, block_size=256):
+        """
+        Average value of each frame, computed block_size frames at a time so
+        that a numpy.memmap of the footage is streamed rather than loaded
+
+        :param frames: frames, i.e. a channel extracted with mmap=True
+        :type: numpy.ndarray or numpy.memmap
+        :param spacetime: if True, average over the first spatial axis only
+        :type: bool
+        :param block_size: number of frames read at a time
+        :type: int>0
+
+        :return: mean of each frame
+        :type: numpy.ndarray
+        """
+        axis = 1 if spacetime else (1, 2)
+        means = None
+        for start in range(0, frames.shape[0], block_size):
+            block = numpy.mean(
+                frames[start:start + block_size], axis=axis
+            )
+            if means is None:
+                means = numpy.empty(
+                    (frames.shape[0],) + block.shape[1:], dtype=block.dtype
+                )
+            means[start:start + block.shape[0]] = block
+        return means
+
+    @staticmethod
+    def threshold_method(frames, threshold=4, block_size=256):
         """
         Remove the dark frames at the start and end of the footage
         (Assume there are no dark frames in between the remaining frames)
 
-        :param frames: frames of channel extracted from RAW file
-        :type: numpy.ndarray
+        :param frames: frames of channel extracted from RAW file; a memmap is
+        streamed block by block
+        :type: numpy.ndarray or numpy.memmap
         :param threshold: threshold for average value per pixel
         :type: float
+        :param block_size: number of frames read at a time
+        :type: int>0
 
         :return: slice object
         :type: slice
         """
-        temporal_means = abs(numpy.mean(frames, axis=(1, 2)))
-        start, end = 0, temporal_means.shape[0]
-
-        for i, mean in enumerate(temporal_means):
-            if mean > threshold:
-                start = i+1
-                break
-        reversed_temporal_means = numpy.flip(
-            temporal_means, axis=0
+        temporal_means = abs(
+            DarkFramesSlice.frame_means(frames, block_size=block_size)
         )
-        del temporal_means
-
-        for i, mean in enumerate(reversed_temporal_means):
-            if mean > threshold:
-                end = end - (i+1)
-                break
+        start, end = 0, temporal_means.shape[0]
+        bright = temporal_means > threshold
+        if bright.any():
+            start = int(numpy.argmax(bright)) + 1
+            end = end - (int(numpy.argmax(bright[::-1])) + 1)
         return slice(start, end)
 
     @staticmethod
     def gradient_method(
-        behaviour_frames, sigma=15, spacetime=False
+        behaviour_frames, sigma=15, spacetime=False, block_size=256
     ):
         """
+        Find the footage between the first jump in brightness and the last
+        frame of steady brightness
+
+        :param behaviour_frames: frames of the footage; a memmap is streamed
+        block by block
+        :type: numpy.ndarray or numpy.memmap
+        :param sigma: number of standard deviations of the gradient of the
+        mean brightness above its mean that counts as a jump
+        :type: float
+        :param spacetime: if True, the mean is taken over the first spatial
+        axis only, and a frame jumps if any column jumps
+        :type: bool
+        :param block_size: number of frames read at a time
+        :type: int>0
 
-        :param behaviour_frames:
-        :param sigma:
-        :param spacetime:
-        :return:
+        :return: slice object
+        :type: slice
         """
-        if spacetime:
-            means = numpy.mean(behaviour_frames, axis=1)
-        else:
-            means = numpy.mean(
-                behaviour_frames, axis=(1, 2)
-            )
-        grads = numpy.gradient(means)
+        means = DarkFramesSlice.frame_means(
+            behaviour_frames, spacetime=spacetime, block_size=block_size
+        )
+        grads = numpy.gradient(means, axis=0)
         mean = numpy.mean(grads)
         std = numpy.std(grads)
         start, end = 0, means.shape[0]
         threshold = mean + std * sigma
-        for i, grad in enumerate(grads):
-            if abs(grad) > threshold:
-                start = i
-                break
-        reversed_grads = numpy.flip(grads, axis=0)
-        del grads
-        for i, grad in enumerate(reversed_grads):
-            if abs(grad) < threshold:
-                end = end - i
-                break
+        above = abs(grads) > threshold
+        below = abs(grads) < threshold
+        if spacetime:
+            above = above.any(axis=1)
+            below = below.all(axis=1)
+        if above.any():
+            start = int(numpy.argmax(above))
+        if below.any():
+            end = end - int(numpy.argmax(below[::-1]))
         return slice(start, end)
 
+    @staticmethod
+    def raw_slice(
+        filename,
+        width,
+        height,
+        channel="green",
+        threshold=4,
+        dtype="uint8",
+        num_channels=3,
+        block_size=256,
+    ):
+        """
+        Slice of the frames of a .RAW file without the dark frames at its
+        start and end, found by streaming the file; pass it as frame_slice to
+        extract_RAW_frames or extract_RAW_channels so that the dark frames are
+        never read
+
+        :param filename: name of .RAW file containing image data
+        :type: str
+        :param width: width of data
+        :type: int
+        :param height: height of data
+        :type: int
+        :param channel: name of channel whose brightness is thresholded
+        :type: str, one of ('red', 'blue', 'green')
+        :param threshold: threshold for average value per pixel
+        :type: float
+        :param dtype: numpy datatype. default is 'uint8'
+        :type: str
+        :param num_channels: one of (1, 3)
+        :type: int
+        :param block_size: number of frames read at a time
+        :type: int>0
 
-def calculate_df_f0(frames):
+        :return: slice object
+        :type: slice
+        """
+        frames = extract_RAW_frames(
+            filename,
+            width,
+            height,
+            channel=channel,
+            dtype=dtype,
+            num_channels=num_channels,
+            mmap=True,
+        )
+        return DarkFramesSlice.threshold_method(
+            frames, threshold=threshold, block_size=block_size
+        )
+
+
+def calculate_df_f0(
+    frames,
+    out=None,
+    baseline="mean",
+    percentile=10,
+    window=144,
+    dtype=numpy.float32,
+    block_size=256,
+):
     """
     Calculate df/f0, the fractional change in intensity for each pixel
     and the variance of df/f0
 
+    The frames are processed block_size frames at a time into a single output
+    buffer, which can be a numpy.memmap or frames itself (if frames is a float
+    array) to compute df/f0 in place. The variance is accumulated in the same
+    pass (Welford/Chan update), so no full-size temporary is allocated.
 
-    :param frames: 3D array of image frames
+    :param frames: 3D array of image frames, any numeric dtype
     :type: numpy.ndarray
-
-    :return: df/f0 with nans masked to -1
+    :param out: array of the shape of frames receiving df/f0; allocated with
+    dtype if unspecified
+    :type: numpy.ndarray
+    :param baseline: f0 of each pixel: 'mean' of all frames, 'percentile' of
+    all frames, or 'sliding' mean of the last `window` frames
+    :type: str
+    :param percentile: percentile used if baseline is 'percentile'
+    :type: float in [0, 100]
+    :param window: number of frames averaged if baseline is 'sliding'
+    :type: int>0
+    :param dtype: data type of the output if out is unspecified
+    :type: numpy.dtype
+    :param block_size: number of frames processed at a time
+    :type: int>0
+
+    :return: df/f0 with nans and pixels with a zero baseline masked to -1
     :type: numpy.ndarray
     :return: variance in df/d0
     :type: numpy.ndarray
     """
-    frames = frames.astype(numpy.float32)
-    baseline = numpy.mean(frames, axis=0)
-    df_f0 = numpy.divide(
-        numpy.subtract(frames, baseline), baseline
-    )
-    del frames, baseline
-    df_f0[
-        numpy.where(numpy.isnan(df_f0))
-    ] = -1  # Make the nans black.
-
-    return df_f0, numpy.var(df_f0, axis=0)
+    if baseline not in ("mean", "percentile", "sliding"):
+        raise AttributeError(
+            "Keyword 'baseline' must be one of: ('mean', 'percentile', 'sliding')"
+        )
+    n_frames = frames.shape[0]
+    if out is None:
+        out = numpy.empty(frames.shape, dtype=dtype)
+    if baseline == "mean":
+        f0 = numpy.zeros(frames.shape[1:], dtype=numpy.float64)
+        for start in range(0, n_frames, block_size):
+            f0 += frames[start:start + block_size].sum(
+                axis=0, dtype=numpy.float64
+            )
+        f0 = (f0 / n_frames).astype(out.dtype)
+    elif baseline == "percentile":
+        f0 = _percentile_baseline(frames, percentile, block_size).astype(
+            out.dtype
+        )
+    else:
+        running = numpy.zeros(frames.shape[1:], dtype=numpy.float64)
+        # Raw frames of the window preceding the block, kept because out may
+        # be frames itself
+        history = numpy.empty((0,) + frames.shape[1:], dtype=out.dtype)
+
+    count = 0
+    mean = numpy.zeros(frames.shape[1:], dtype=numpy.float64)
+    m2 = numpy.zeros(frames.shape[1:], dtype=numpy.float64)
+    for start in range(0, n_frames, block_size):
+        stop = min(start + block_size, n_frames)
+        block = out[start:stop]
+        if baseline == "sliding":
+            raw = frames[start:stop].astype(out.dtype)
+            f0, running = _sliding_mean_block(
+                raw, history, running, start, window
+            )
+            history = numpy.concatenate([history, raw])[-window:]
+            numpy.subtract(raw, f0, out=block, casting="unsafe")
+            zero = f0 == 0
+        else:
+            numpy.subtract(frames[start:stop], f0, out=block, casting="unsafe")
+            zero = numpy.broadcast_to(f0 == 0, block.shape)
+        numpy.divide(block, f0, out=block, where=~zero)
+        block[zero] = -1  # Make the pixels without baseline black.
+        numpy.copyto(block, -1, where=numpy.isnan(block))  # Make the nans black.
+
+        # Merge the mean and sum of squares of the block into the totals
+        n = stop - start
+        block_mean = block.mean(axis=0, dtype=numpy.float64)
+        block_m2 = numpy.var(block, axis=0, dtype=numpy.float64) * n
+        delta = block_mean - mean
+        total = count + n
+        mean += delta * (n / total)
+        m2 += block_m2 + delta ** 2 * (count * n / total)
+        count = total
+
+    return out, (m2 / count).astype(out.dtype)
+
+
+def _percentile_baseline(frames, percentile, block_size):
+    """
+    Per-pixel percentile over time, computed on tiles of rows of about
+    block_size frames worth of pixels
+    """
+    f0 = numpy.empty(frames.shape[1:], dtype=numpy.float64)
+    rows = max(1, block_size * frames.shape[1] // max(frames.shape[0], 1))
+    for row in range(0, frames.shape[1], rows):
+        f0[row:row + rows] = numpy.percentile(
+            frames[:, row:row + rows], percentile, axis=0
+        )
+    return f0
 
 
-def calculate_df_f0_moving(frames, n=144, axis=0):
+def _sliding_mean_block(raw, history, running, start, window):
     """
-    Calculate df/f0, the fractional change in intensity for each pixel
-    and the variance of df/f0 with a moving baseline (f0)
-
+    Mean of the last `window` frames (fewer at the start of the recording) for
+    each frame of a block, continuing the float64 running sum of the previous
+    block. history holds the raw frames preceding the block.
+    """
+    n = raw.shape[0]
+    increments = raw.astype(numpy.float64)
+    # Frames leaving the window: frame t - window, when it exists
+    leaving = numpy.arange(start, start + n) - window
+    valid = leaving >= 0
+    frames = numpy.concatenate([history, raw])
+    offset = start - history.shape[0]
+    increments[valid] -= frames[leaving[valid] - offset]
+    # Running sum frame by frame; numpy.cumsum along the first axis is
+    # much slower on C-ordered stacks
+    sums = increments
+    sums[0] += running
+    for i in range(1, n):
+        numpy.add(sums[i], sums[i - 1], out=sums[i])
+    running = sums[-1].copy()
+    counts = numpy.minimum(numpy.arange(start, start + n) + 1, window)
+    counts = counts.reshape((n,) + (1,) * (raw.ndim - 1))
+    f0 = (sums / counts).astype(raw.dtype)
+    return f0, running
+
+
+def calculate_df_f0_moving(
+    frames,
+    n=144,
+    axis=0,
+    kernel="mean",
+    percentile=10,
+    out=None,
+    n_jobs=None,
+    block_size=256,
+):
+    """
+    Calculate df/f0, the fractional change in intensity for each pixel,
+    with a moving baseline (f0) taken over the last n frames (fewer at the
+    start of the recording)
+
+    The baseline of each frame is the mean, median or a low percentile of the
+    window. The mean is a float64 running sum carried block to block; the
+    median and percentiles are running order statistics, from a histogram of
+    the window of each pixel carried block to block for 8-bit frames, and from
+    scipy.ndimage.rank_filter for wider types. Tiles of rows are processed in
+    parallel by threads sharing frames and out, one block of frames at a time,
+    so no copy of the stack is made.
 
-    :param n: size of moving window
-    :param axis: axis to compute mean along (default 0)
     :param frames: 3D array of image frames
     :type: numpy.ndarray
+    :param n: size of moving window
+    :type: int>0
+    :param axis: time axis of frames (default 0)
+    :type: int
+    :param kernel: baseline of the window: 'mean', 'median' or 'percentile'
+    :type: str
+    :param percentile: percentile of the window if kernel is 'percentile';
+    percentiles are taken as the window value of nearest rank
+    :type: float in [0, 100]
+    :param out: array of the shape of frames receiving df/f0, i.e. a
+    numpy.memmap; float32 array allocated if unspecified
+    :type: numpy.ndarray
+    :param n_jobs: number of workers to utilise for parallel jobs
+    :type: None or int>0
+    :param block_size: number of frames processed at a time by each worker
+    :type: int>0
 
-    :return: df/f0 with nans masked to -1
+    :return: df/f0 with nans and pixels with a zero baseline masked to -1
     :type: numpy.ndarray
     """
-    #
-    frames = frames.astype(numpy.float32)
-    baseline = numpy.cumsum(frames, axis, dtype=numpy.float32)
-    baseline[n:] = baseline[n:] - baseline[:-n]
-    baseline[n-1:] = baseline[n-1:] / n
-
-    prelim = numpy.arange(n)
-
-    # df_f0[:n-1] = df_f0[:n-1] / prelim[1:]
-    baseline[:n - 1] = baseline[:n - 1] / prelim[1:, None, None]
-
-    df_f0 = frames - baseline
+    if kernel not in ("mean", "median", "percentile"):
+        raise AttributeError(
+            "Keyword 'kernel' must be one of: ('mean', 'median', 'percentile')"
+        )
+    if kernel == "median":
+        percentile = 50
+    if out is None:
+        out = numpy.empty(frames.shape, dtype=numpy.float32)
+    frames = numpy.moveaxis(frames, axis, 0)
+    out_view = numpy.moveaxis(out, axis, 0)
+    if n_jobs is None:
+        n_jobs = cpu_count()
+
+    tiles = list(gen_even_slices(frames.shape[1], min(n_jobs, frames.shape[1])))
+    # Workers share memory with the caller and write their blocks straight into out
+    Parallel(n_jobs=n_jobs, require="sharedmem", verbose=0)(
+        delayed(_moving_df_f0_tile)(
+            frames, out_view, rows, n, kernel, percentile, block_size
+        )
+        for rows in tiles
+    )
+    return out
 
-    # df_f0 = numpy.divide(
-    #     numpy.subtract(frames, baseline), baseline
-    # )
-    # del frames, baseline
-    # df_f0[
-    #     numpy.where(numpy.isnan(df_f0))
-    # ] = -1  # Make the nans black.
 
-    return df_f0
+def _moving_df_f0_tile(frames, out, rows, n, kernel, percentile, block_size):
+    """
+    Moving-baseline df/f0 of the pixels in rows of every frame, written to
+    out block by block
+    """
+    if kernel == "mean":
+        baselines = _moving_mean_baseline(frames, rows, n, out.dtype, block_size)
+    else:
+        baselines = _moving_rank_baseline(frames, rows, n, percentile, block_size)
 
-    # ret = np.cumsum(frames, axis=0, dtype=float)
-    # ret[n:] = ret[n:] - ret[:-n]
-    # ret[n - 1:] = ret[n - 1:] / n
-    # return ret
+    for start, block, f0 in baselines:
+        result = numpy.empty(block.shape, dtype=out.dtype)
+        numpy.subtract(block, f0, out=result, dtype=out.dtype, casting="unsafe")
+        zero = f0 == 0
+        numpy.divide(result, f0, out=result, where=~zero)
+        result[zero] = -1  # Make the pixels without baseline black.
+        numpy.copyto(result, -1, where=numpy.isnan(result))  # Make the nans black.
+        target = out[start:start + block.shape[0], rows]
+        target[...] = result.reshape(target.shape)
 
 
+def _moving_mean_baseline(frames, rows, n, dtype, block_size):
+    """
+    Yields (start, block, f0) with f0 the mean of the last n frames, for
+    blocks of frames flattened to (frames, pixels)
+    """
+    history = None
+    running = None
+    for start in range(0, frames.shape[0], block_size):
+        block = numpy.asarray(frames[start:start + block_size, rows])
+        block = block.reshape(block.shape[0], -1)
+        if history is None:
+            history = numpy.empty((0, block.shape[1]), dtype=dtype)
+            running = numpy.zeros(block.shape[1], dtype=numpy.float64)
+        raw = block.astype(dtype)
+        f0, running = _sliding_mean_block(raw, history, running, start, n)
+        history = numpy.concatenate([history, raw])[-n:]
+        yield start, block, f0
+
+
+def _moving_rank_baseline(frames, rows, n, percentile, block_size):
+    """
+    Yields (start, block, f0) with f0 the value of nearest rank to the
+    percentile of the last n frames, for blocks of frames flattened to
+    (frames, pixels). 8-bit frames are ranked with a running histogram of each
+    pixel and a pointer to the selected value (Huang's algorithm), updated for
+    all pixels of the tile at once and carried from block to block; other
+    types fall back to a rank filter along the time series of each pixel.
+    """
+    if numpy.dtype(frames.dtype).itemsize != 1 or frames.dtype.kind not in "ui":
+        yield from _moving_rank_baseline_series(frames, rows, n, percentile, block_size)
+        return
+    offset = 128 if frames.dtype.kind == "i" else 0
+    history = None
+    for start in range(0, frames.shape[0], block_size):
+        block = numpy.asarray(frames[start:start + block_size, rows])
+        block = block.reshape(block.shape[0], -1)
+        if history is None:
+            n_pixels = block.shape[1]
+            # Counts of each value in the window, the selected value and the
+            # number of window values below it, for every pixel
+            counts = numpy.zeros(n_pixels * 256, dtype=numpy.int32)
+            bins = numpy.arange(n_pixels) * 256
+            value = numpy.zeros(n_pixels, dtype=numpy.int64)
+            below = numpy.zeros(n_pixels, dtype=numpy.int64)
+            history = numpy.empty((n, n_pixels), dtype=numpy.int64)
+        f0 = numpy.empty(block.shape, dtype=numpy.int64)
+        for i, frame in enumerate(block.astype(numpy.int64) + offset):
+            t = start + i
+            if t >= n:
+                old = history[t % n]
+                counts[bins + old] -= 1
+                below -= old < value
+            counts[bins + frame] += 1
+            below += frame < value
+            history[t % n] = frame
+            rank = round((min(t + 1, n) - 1) * (percentile / 100))
+            # Move the pointer down while too many values are below it, then
+            # up while the values below and at it do not reach the rank
+            high = numpy.flatnonzero(below > rank)
+            while high.size:
+                value[high] -= 1
+                below[high] -= counts[bins[high] + value[high]]
+                high = high[below[high] > rank]
+            low = numpy.flatnonzero(below + counts[bins + value] <= rank)
+            while low.size:
+                below[low] += counts[bins[low] + value[low]]
+                value[low] += 1
+                low = low[below[low] + counts[bins[low] + value[low]] <= rank]
+            f0[i] = value
+        yield start, block, (f0 - offset).astype(frames.dtype)
+
+
+def _moving_rank_baseline_series(frames, rows, n, percentile, block_size):
+    """
+    _moving_rank_baseline of frames wider than 8 bits: each block is read with
+    the n - 1 frames before it, so that a running rank filter along the time
+    series of each pixel sees full windows; the shorter windows at the start
+    are selected directly.
+    """
+    rank = round((n - 1) * percentile / 100)
+    n_frames = frames.shape[0]
+    for start in range(0, n_frames, block_size):
+        stop = min(start + block_size, n_frames)
+        first = max(start - (n - 1), 0)
+        series = numpy.asarray(frames[first:stop, rows])
+        series = numpy.ascontiguousarray(series.reshape(series.shape[0], -1).T)
+        f0 = numpy.empty_like(series)
+        if series.shape[1] >= n:
+            for pixel in range(series.shape[0]):
+                # origin shifts the window to the n frames ending at each frame
+                f0[pixel] = ndimage.rank_filter(
+                    series[pixel], rank, size=n, origin=(n - 1) // 2
+                )
+        for t in range(start, min(n - 1, stop)):
+            f0[:, t - first] = numpy.percentile(
+                series[:, :t + 1 - first], percentile, axis=1, method="nearest"
+            )
+        yield start, series[:, start - first:].T, f0[:, start - first:].T
 
 
 class Filter:
@@ -439,6 +1037,7 @@ class Filter:
         frame_rate,
         order=4,
         rp=0.1,
+        zero_phase=False,
     ):
         """
         Create Bandpass Filter object with frequency cutoff attributes
@@ -453,6 +1052,8 @@ class Filter:
         :type: int
         :param rp: maximum ripple allowed below unity gain in the passband. Specified in decibels, as a positive number
         :type: float>0
+        :param zero_phase: if True, filter forwards and backwards (sosfiltfilt) so the output has no phase delay
+        :type: bool
         """
         nyq = frame_rate * 0.5
         passband = low_freq_cutoff / nyq
@@ -469,6 +1070,26 @@ class Filter:
             numerator,
             denominator,
         )
+        # Second-order sections stay stable for cutoffs close to 0 Hz,
+        # where the (b, a) form loses precision
+        self.sos = signal.cheby1(
+            order,
+            rp,
+            Wn=[passband, stopband],
+            btype="bandpass",
+            analog=False,
+            output="sos",
+        )
+        self.zero_phase = zero_phase
+        # Constructor arguments, i.e. for keying cached results of this filter
+        self.params = dict(
+            low_freq_cutoff=low_freq_cutoff,
+            high_freq_cutoff=high_freq_cutoff,
+            frame_rate=frame_rate,
+            order=order,
+            rp=rp,
+            zero_phase=zero_phase,
+        )
 
     @staticmethod
     def lfilter(numerator, denominator, data, axis=0):
@@ -479,38 +1100,96 @@ class Filter:
             numerator, denominator, data, axis
         )
 
-    def filter(self, frames, n_jobs=None):
+    @staticmethod
+    def sosfilt(sos, frames, out, pixels, zero_phase=False):
         """
-        Use joblib to apply scipy.filter.lfilter to the data in parallel
+        Filter the pixel columns `pixels` of `frames` along the time-axis and
+        write the result into the same columns of `out`
+        """
+        if zero_phase:
+            out[:, pixels] = signal.sosfiltfilt(sos, frames[:, pixels], axis=0)
+        else:
+            out[:, pixels] = signal.sosfilt(sos, frames[:, pixels], axis=0)
+
+    def filter(self, frames, n_jobs=None, out=None, block_size=4096):
+        """
+        Use joblib to apply the second-order sections filter to the data in parallel.
+        Workers share memory with the caller and write their blocks of pixels
+        straight into one output buffer.
 
         :param frames: frames to apply filter to
         :type: numpy.ndarray
         :param n_jobs: number of workers to utilise for parallel jobs
         :type: None or int>0
-
-        :return: frames with applied lfilter
+        :param out: C-contiguous float buffer of the same shape as frames to write the
+        result to, i.e. a numpy.memmap or frames itself to filter in place; a new float32
+        array is allocated if None
+        :type: None or numpy.ndarray
+        :param block_size: maximum number of pixels filtered per task
+        :type: int>0
+
+        :return: filtered frames
         :type: numpy.ndarray
         """
         n_frames, height, width = frames.shape
+        if out is None:
+            out = numpy.empty((n_frames, height, width), dtype=numpy.float32)
+        elif out.shape != frames.shape:
+            raise ValueError(
+                f"Argument `out` should have shape {frames.shape}, {out.shape} given instead"
+            )
+        elif not out.flags.c_contiguous:
+            # Reshaping would copy out, and the workers would fill the copy
+            raise ValueError("Argument `out` should be C-contiguous")
         frames = frames.reshape(n_frames, height * width)
+        columns = out.reshape(n_frames, height * width)
 
         if n_jobs is None:
             n_jobs = cpu_count()
-        bandpass_filter = delayed(Filter.lfilter)
-        result = Parallel(n_jobs=16, verbose=0)(
+        n_blocks = max(n_jobs, -(-frames.shape[1] // block_size))
+        bandpass_filter = delayed(Filter.sosfilt)
+        # scipy releases the GIL while filtering, so threads sharing the
+        # output buffer run in parallel without copying any data
+        Parallel(n_jobs=n_jobs, require="sharedmem", verbose=0)(
             bandpass_filter(
-                self.numerator,
-                self.denominator,
-                frames[:, s]
-            )
-            for s in gen_even_slices(
-                frames.shape[1], n_jobs
+                self.sos, frames, columns, s, self.zero_phase
             )
+            for s in gen_even_slices(frames.shape[1], n_blocks)
         )
 
-        return numpy.hstack(result).reshape(
-            n_frames, height, width
-        )
+        return out
+
+    def initial_state(self, n_signals):
+        """
+        Zero initial conditions for filtering a recording block by block
+
+        :param n_signals: number of independent traces (pixels) filtered together
+        :type: int>0
+
+        :return: filter state to pass to the first call of filter_block
+        :type: numpy.ndarray
+        """
+        return numpy.zeros((self.sos.shape[0], 2, n_signals))
+
+    def filter_block(self, block, state):
+        """
+        Filter one block of a longer recording along the time axis, carrying the
+        filter state over from the previous block so that the concatenated output
+        equals filtering the whole recording at once
+
+        :param block: frames reshaped to (n_frames, n_signals)
+        :type: numpy.ndarray
+        :param state: state returned by initial_state or by the previous call
+        :type: numpy.ndarray
+
+        :return: filtered block and the state for the next block
+        :type: tuple of numpy.ndarray
+        """
+        if self.zero_phase:
+            raise ValueError(
+                "Zero-phase filtering needs the whole recording and cannot be applied block by block"
+            )
+        return signal.sosfilt(self.sos, block, axis=0, zi=state)
 
 
 def correct_channel_a_by_b(a, b):
@@ -529,14 +1208,334 @@ def correct_channel_a_by_b(a, b):
     return a-b
 
 
-def load_frames(filename, color):
+def preprocess_RAW_stream(
+    filename,
+    output,
+    width,
+    height,
+    filt,
+    channel_a="green",
+    channel_b="blue",
+    dtype="uint8",
+    block_size=512,
+):
     """
-    Load frames of .h264/5 as color channel(s) or B&W frames as numpy array
+    Stream a .RAW recording through df/f0, the bandpass filter and the correction
+    of channel a by channel b, writing float32 frames straight to disk.
+
+    The baseline of each channel is computed in a first pass over the file; the
+    second pass reads blocks of frames and carries the filter state across blocks,
+    so peak memory depends on block_size and not on the length of the recording.
 
-    :param filename: path to video file
+    :param filename: name of .RAW file containing RGB image data
+    :type: str
+    :param output: path of the float32 .raw file to write the corrected frames to
+    :type: str
+    :param width: width of data
+    :type: int
+    :param height: height of data
+    :type: int
+    :param filt: bandpass filter to apply to each channel
+    :type: Filter
+    :param channel_a: channel corrected by channel b, one of ('red', 'green', 'blue')
+    :type: optional str. default is 'green'
+    :param channel_b: channel used for the correction, one of ('red', 'green', 'blue')
+    :type: optional str. default is 'blue'
+    :param dtype: numpy datatype of the .RAW file. default is 'uint8'
+    :type: optional str
+    :param block_size: number of frames processed at a time
+    :type: optional int>0
+
+    :return: number of frames written to output
+    :type: int
+    """
+    raw_frames = extract_RAW_frames(
+        filename, width, height, dtype=dtype, mmap=True
+    )
+    indices = []
+    for channel in (channel_a, channel_b):
+        index = {"red": 0, "green": 1, "blue": 2}.get(channel)
+        if index is None:
+            raise AttributeError(
+                "Channels must be one of: ('red', 'blue', 'green')"
+            )
+        indices.append(index)
+    baselines = _raw_channel_baselines(raw_frames, indices, block_size)
+    blocks_a, blocks_b = (
+        _filtered_channel_blocks(raw_frames, index, baseline, filt, block_size)
+        for index, baseline in zip(indices, baselines)
+    )
+    with open(output, "wb") as file:
+        for block_a, block_b in zip(blocks_a, blocks_b):
+            corrected = correct_channel_a_by_b(block_a, block_b)
+            corrected.astype(numpy.float32).tofile(file)
+    return raw_frames.shape[0]
+
+
+def filter_RAW_channel_stream(
+    filename,
+    output,
+    width,
+    height,
+    filt,
+    channel="green",
+    dtype="uint8",
+    block_size=512,
+):
+    """
+    Stream one channel of a .RAW recording through df/f0 and the bandpass filter,
+    writing float32 frames straight to disk
+
+    :param filename: name of .RAW file containing RGB image data
+    :type: str
+    :param output: path of the float32 .raw file to write the filtered frames to
+    :type: str
+    :param width: width of data
+    :type: int
+    :param height: height of data
+    :type: int
+    :param filt: bandpass filter to apply
+    :type: Filter
+    :param channel: channel to process, one of ('red', 'green', 'blue')
+    :type: optional str. default is 'green'
+    :param dtype: numpy datatype of the .RAW file. default is 'uint8'
+    :type: optional str
+    :param block_size: number of frames processed at a time
+    :type: optional int>0
+
+    :return: number of frames written to output
+    :type: int
+    """
+    index = {"red": 0, "green": 1, "blue": 2}.get(channel)
+    if index is None:
+        raise AttributeError(
+            "Keyword 'channel' must be one of: ('red', 'blue', 'green')"
+        )
+    raw_frames = extract_RAW_frames(
+        filename, width, height, dtype=dtype, mmap=True
+    )
+    (baseline,) = _raw_channel_baselines(raw_frames, [index], block_size)
+    with open(output, "wb") as file:
+        for block in _filtered_channel_blocks(
+            raw_frames, index, baseline, filt, block_size
+        ):
+            block.astype(numpy.float32).tofile(file)
+    return raw_frames.shape[0]
+
+
+def correct_RAW_stream(file_a, file_b, output, width, height, block_size=512):
+    """
+    Correct the float32 frames in file_a by those in file_b block by block,
+    writing the float32 result straight to disk
+
+    :param file_a: float32 .raw file of channel a, i.e. from filter_RAW_channel_stream
+    :type: str
+    :param file_b: float32 .raw file of channel b
+    :type: str
+    :param output: path of the float32 .raw file to write the corrected frames to
+    :type: str
+    :param width: width of data
+    :type: int
+    :param height: height of data
+    :type: int
+    :param block_size: number of frames processed at a time
+    :type: optional int>0
+
+    :return: number of frames written to output
+    :type: int
+    """
+    frames_a = extract_RAW_frames(
+        file_a, width, height, dtype="float32", num_channels=1, mmap=True
+    )
+    frames_b = extract_RAW_frames(
+        file_b, width, height, dtype="float32", num_channels=1, mmap=True
+    )
+    n_frames = min(frames_a.shape[0], frames_b.shape[0])
+    with open(output, "wb") as file:
+        for start in range(0, n_frames, block_size):
+            stop = min(start + block_size, n_frames)
+            corrected = correct_channel_a_by_b(
+                frames_a[start:stop], frames_b[start:stop]
+            )
+            corrected.astype(numpy.float32).tofile(file)
+    return n_frames
+
+
+def _raw_channel_baselines(raw_frames, indices, block_size):
+    """
+    Per-pixel temporal mean (f0) of the given channels, accumulated in float64
+    over blocks of frames
+    """
+    n_frames, height, width, _ = raw_frames.shape
+    sums = numpy.zeros((len(indices), height, width), dtype=numpy.float64)
+    for start in range(0, n_frames, block_size):
+        block = raw_frames[start : start + block_size]
+        for k, index in enumerate(indices):
+            sums[k] += numpy.sum(block[..., index], axis=0, dtype=numpy.float64)
+    return (sums / n_frames).astype(numpy.float32)
+
+
+def _filtered_channel_blocks(raw_frames, index, baseline, filt, block_size):
+    """
+    Generator of bandpass filtered df/f0 blocks of one channel, shaped
+    (n_frames, height, width), with the filter state carried across blocks
+    """
+    n_frames, height, width, _ = raw_frames.shape
+    state = filt.initial_state(height * width)
+    for start in range(0, n_frames, block_size):
+        block = raw_frames[start : start + block_size, ..., index]
+        df_f0 = numpy.divide(
+            numpy.subtract(block, baseline, dtype=numpy.float32), baseline
+        )
+        df_f0[numpy.isnan(df_f0)] = -1  # Make the nans black.
+        filtered, state = filt.filter_block(
+            df_f0.reshape(-1, height * width), state
+        )
+        yield filtered.reshape(-1, height, width)
+
+
+class VideoSession:
+    """
+    Behaviour video recorded in segments by high_speed_camera_LabJack.py, read through its
+    '<date>-<camera>-manifest.json' as one video. It has the interface of cv2.VideoCapture
+    used here (isOpened, grab, read, get, set, release); setting CAP_PROP_POS_FRAMES opens
+    only the segment holding the frame, without decoding the segments before it.
+    """
+
+    def __init__(self, manifest):
+        """
+        :param manifest: path to the manifest of the video
+        :type: str
+        """
+        with open(manifest) as f:
+            self.manifest = json.load(f)
+        directory = os.path.dirname(os.path.abspath(manifest))
+        self.segments = self.manifest["segments"]
+        self.files = [os.path.join(directory, s["file"]) for s in self.segments]
+        self.starts = [s["start"] for s in self.segments]
+        self.frame_count = self.segments[-1]["stop"] if self.segments else 0
+        self._cap = None
+        self._segment = -1
+        self.position = 0
+        self._opened = True
+
+    def __len__(self):
+        return self.frame_count
+
+    def segment(self, frame):
+        """
+        :return: index of the segment holding frame
+        :type: int
+        """
+        return bisect.bisect_right(self.starts, frame) - 1
+
+    def _open(self, segment):
+        if self._cap is not None:
+            self._cap.release()
+        self._cap = cv2.VideoCapture(self.files[segment])
+        if not self._cap.isOpened():
+            raise FileNotFoundError(f"Cannot open {self.files[segment]}")
+        self._segment = segment
+
+    def seek(self, frame):
+        """
+        Move to frame, opening its segment
+
+        :param frame: index of the frame in the whole video
+        :type: int
+        """
+        if not 0 <= frame < self.frame_count:
+            raise IndexError(f"Frame {frame} out of range 0-{self.frame_count}")
+        segment = self.segment(frame)
+        if segment != self._segment:
+            self._open(segment)
+        self._cap.set(cv2.CAP_PROP_POS_FRAMES, frame - self.starts[segment])
+        self.position = frame
+
+    def _next(self):
+        # Open the segment of the next frame, on the first call and at segment boundaries
+        if self.position >= self.frame_count:
+            return False
+        if self._segment < 0 or self.position >= self.segments[self._segment]["stop"]:
+            self._open(self.segment(self.position))
+        return True
+
+    def grab(self):
+        if not self._next():
+            return False
+        ok = self._cap.grab()
+        self.position += ok
+        return ok
+
+    def read(self):
+        if not self._next():
+            return False, None
+        ok, frame = self._cap.read()
+        self.position += ok
+        return ok, frame
+
+    def isOpened(self):
+        return self._opened
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return self.frame_count
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.position
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.manifest["width"]
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.manifest["height"]
+        if prop == cv2.CAP_PROP_FPS:
+            return self.manifest["fps"]
+        return 0
+
+    def set(self, prop, value):
+        if prop != cv2.CAP_PROP_POS_FRAMES:
+            return False
+        self.seek(int(value))
+        return True
+
+    def release(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+        self._segment = -1
+        self._opened = False
+
+
+def open_video(filename):
+    """
+    Open a video file, or a segmented behaviour video through its manifest
+
+    :param filename: path to a video file or to a '-manifest.json' file
+    :type: str
+
+    :return: the opened video
+    :type: cv2.VideoCapture or VideoSession
+    """
+    if str(filename).endswith(".json"):
+        return VideoSession(filename)
+    return cv2.VideoCapture(filename)
+
+
+def load_frames(filename, color, start=0, stop=None, step=1):
+    """
+    Load frames of .h264/5 as color channel(s) or B&W frames as numpy array.
+    The video is decoded once into an array sized from the container's frame count,
+    which grows if the count turns out to be too small. For a segmented video the reading
+    starts in the segment holding `start`.
+
+    :param filename: path to video file, or to the manifest of a segmented video (see VideoSession)
     :type: str
     :param color: one of ('red', 'green', 'blue', 'all', False), with False for B&W
     :type: str or bool
+    :param start: index of the first frame to load
+    :type: int>=0
+    :param stop: index after the last frame to load; the end of the video if None
+    :type: None or int
+    :param step: load every step-th frame; skipped frames are not decoded into images
+    :type: int>0
 
     :return: video frames
     :type: numpy.ndarray
@@ -546,43 +1545,174 @@ def load_frames(filename, color):
         raise AttributeError(
             "Argument 'color' must be one of ('red', 'green', 'blue', 'all', False)"
         )
-    cap = cv2.VideoCapture(filename)
-    num_frames = 0
-    first_frame = True
-    while cap.isOpened:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        if first_frame:
-            height, width, _ = frame.shape
-            first_frames = False
-        num_frames +=1
-    cap.release()
-    if num_frames == 0:
-        raise Exception(f"No frames found in 'filename'")
-    if color == 'all':
-        frames = numpy.zeros((num_frames, height, width, 3), dtype=numpy.uint8)
-    else: 
-        frames = numpy.zeros((num_frames, height, width), dtype=numpy.uint8)
+    if start < 0 or step < 1:
+        raise ValueError(
+            "Arguments 'start' and 'step' must be >= 0 and >= 1"
+        )
+    cap = open_video(filename)
+    num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    end = num_frames if stop is None else min(stop, num_frames)
+    expected = max(len(range(start, end, step)), 1)
+
+    frames = None
     index = 0
-    cap = cv2.VideoCapture(filename)
-    while cap.isOpened():
+    position = 0
+    if isinstance(cap, VideoSession) and 0 < start < num_frames:
+        cap.seek(start)
+        position = start
+    while cap.isOpened() and (stop is None or position < stop):
+        if position < start or (position - start) % step:
+            # Advance without retrieving the image
+            if not cap.grab():
+                break
+            position += 1
+            continue
         ret, frame = cap.read()
         if not ret:
             break
+        position += 1
+        if frames is None:
+            height, width, _ = frame.shape
+            shape = (expected, height, width, 3) if color == 'all' else (expected, height, width)
+            frames = numpy.empty(shape, dtype=numpy.uint8)
+        elif index == frames.shape[0]:
+            # The container under-reported its frame count
+            frames = numpy.concatenate((frames, numpy.empty_like(frames)))
         if not color:
-            frames[index] = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=frames[index])
         elif color == 'all':
-            frames[index] = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frames[index])
         else:
-            frames[index] = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)[
-                ..., channel
-            ]
-        index+=1
+            # OpenCV decodes to BGR, so the channel can be taken without converting
+            frames[index] = frame[..., 2 - channel]
+        index += 1
     cap.release()
+    if index == 0:
+        raise Exception(f"No frames found in '{filename}'")
+    if index < frames.shape[0]:
+        frames = frames[:index].copy()
     return frames
 
 
+def load_behaviour_timestamps(filename):
+    """
+    Load the frame timestamps written by high_speed_camera_LabJack.py
+
+    :param filename: path to the '<date>-<camera>-timestamp.csv' file or to the
+                     binary '<date>-<camera>-timestamp.npy' log
+    :type: str
+
+    :return: timestamps in seconds since the first frame, one per frame of the video
+    :type: numpy.ndarray
+    """
+    if str(filename).endswith(".npy"):
+        records = numpy.load(filename, mmap_mode="r")
+        records = numpy.asarray(records[records["frame_id"] >= 0])
+        if "video_frame" in records.dtype.names:
+            # One timestamp per video frame: the frame shown at each position, which is
+            # repeated over the frames dropped before it
+            records = records[records["written"] == 1]
+            if len(records) > 0:
+                positions = numpy.arange(records["video_frame"][-1] + 1)
+                records = records[numpy.searchsorted(records["video_frame"], positions)]
+        device_ns = records["device_ns"]
+        return (device_ns - device_ns[:1]) / 1e9
+    return pandas.read_csv(filename)["timestamp"].to_numpy(
+        dtype=numpy.float64
+    )
+
+
+def align_timestamps(reference, timestamps, mode="nearest", tolerance=None):
+    """
+    Map every timestamp of a reference clock onto a stream with its own, sorted timestamps.
+    Both arrays must use the same units, i.e. seconds, and be sorted.
+
+    :param reference: timestamps of the common clock, i.e. the cortical frames
+    :type: numpy.ndarray
+    :param timestamps: timestamps of the stream to resample
+    :type: numpy.ndarray
+    :param mode: one of ('nearest', 'previous', 'linear')
+        'nearest': index of the closest stream frame (the earlier one on ties)
+        'previous': index of the last stream frame at or before the reference time
+        'linear': index of the stream frame before the reference time and the weight of the frame after it
+    :type: str
+    :param tolerance: maximum distance to the matched stream frame; in 'nearest' and 'previous' mode
+                      matches further away are set to -1
+    :type: None or float
+
+    :return: stream index for each reference timestamp, -1 where there is none;
+             in 'linear' mode a tuple (indices, weights) such that the resampled value is
+             (1 - weights) * x[indices] + weights * x[indices + 1]
+    :type: numpy.ndarray or tuple of numpy.ndarray
+    """
+    if mode not in ("nearest", "previous", "linear"):
+        raise AttributeError(
+            "Keyword 'mode' must be one of: ('nearest', 'previous', 'linear')"
+        )
+    reference = numpy.asarray(reference, dtype=numpy.float64)
+    timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+    n = timestamps.shape[0]
+    if n == 0:
+        raise ValueError("Argument `timestamps` is empty")
+
+    if mode == "previous":
+        indices = numpy.searchsorted(timestamps, reference, side="right") - 1
+        if tolerance is not None:
+            distance = reference - timestamps[numpy.maximum(indices, 0)]
+            indices[distance > tolerance] = -1
+        return indices
+
+    if mode == "nearest":
+        upper = numpy.searchsorted(timestamps, reference, side="left")
+        lower = numpy.clip(upper - 1, 0, n - 1)
+        upper = numpy.minimum(upper, n - 1)
+        lower_distance = numpy.abs(reference - timestamps[lower])
+        upper_distance = numpy.abs(timestamps[upper] - reference)
+        indices = numpy.where(lower_distance <= upper_distance, lower, upper)
+        if tolerance is not None:
+            indices[numpy.minimum(lower_distance, upper_distance) > tolerance] = -1
+        return indices
+
+    if n < 2:
+        raise ValueError("Linear interpolation needs at least two timestamps")
+    indices = numpy.clip(
+        numpy.searchsorted(timestamps, reference, side="right") - 1, 0, n - 2
+    )
+    weights = (reference - timestamps[indices]) / (
+        timestamps[indices + 1] - timestamps[indices]
+    )
+    outside = (reference < timestamps[0]) | (reference > timestamps[-1])
+    indices[outside] = -1
+    return indices, numpy.clip(weights, 0, 1)
+
+
+def synchronise_streams(reference, streams, mode="nearest", tolerance=None):
+    """
+    Map several streams onto one common clock, see align_timestamps
+
+    :param reference: timestamps of the common clock, i.e. clean_raw_timestamps output in seconds
+    :type: numpy.ndarray
+    :param streams: sorted timestamps of each stream, i.e. from load_behaviour_timestamps
+    :type: list of numpy.ndarray or dict
+    :param mode: one of ('nearest', 'previous', 'linear')
+    :type: str
+    :param tolerance: maximum distance to the matched frame, see align_timestamps
+    :type: None or float
+
+    :return: align_timestamps output of each stream, keyed like streams if it is a dict
+    :type: list or dict
+    """
+    if isinstance(streams, dict):
+        return {
+            name: align_timestamps(reference, timestamps, mode, tolerance)
+            for name, timestamps in streams.items()
+        }
+    return [
+        align_timestamps(reference, timestamps, mode, tolerance)
+        for timestamps in streams
+    ]
+
+
 def video_synchronisation_indices(
     A_period, A_frames, B_period, B_frames
 ):
@@ -599,20 +1729,122 @@ def video_synchronisation_indices(
     t_max = min(A_total_time, B_total_time)
     A = numpy.arange(0, t_max, A_period)
     B = numpy.arange(0, t_max, B_period)
+    if A.size == 0 or B.size == 0:
+        # A video with fewer than two frames has no overlap to match
+        return [], []
+
+    A_indices = align_timestamps(B, A, mode="nearest")
+    # If the closest match to the timestamp in B is within one
+    # period of B, we can use it
+    # We also keep the corresponding index of B if B is shorter than A
+    B_indices = numpy.flatnonzero(
+        numpy.abs(A[A_indices] - B) <= B_period
+    )
+    return A_indices[B_indices].tolist(), B_indices.tolist()
 
-    A_indices, B_indices = [], []
-    for B_index, timestamp in enumerate(B):
-        abs_difference = numpy.abs(A - timestamp)
-        minimum = abs_difference.min()
-        # If the closest match to the timestamp in B is within one
-        # period of B, we can use it
-        # We also keep the corresponding index of B if B is shorter than A
-        if minimum <= B_period:
-            A_indices.append(
-                numpy.where(abs_difference == minimum)[0][0]
-            )
-            B_indices.append(B_index)
-    return A_indices, B_indices
+
+def resample_behaviour_video(
+    filename,
+    output,
+    reference,
+    timestamps=None,
+    fps=30,
+    mode="nearest",
+    tolerance=None,
+    fourcc="mp4v",
+):
+    """
+    Write a copy of a behaviour video with one frame per imaging frame, decoding the input
+    sequentially and skipping (grab without retrieve) every frame that is not needed.
+    Only one decoded frame is held in memory at a time.
+
+    :param filename: path to behaviour video, i.e. '<date>-whisker.avi', or to the manifest of a
+                     segmented video, i.e. '<date>-whisker-manifest.json' (see VideoSession), in
+                     which case long runs of skipped frames are jumped over by seeking
+    :type: str
+    :param output: path to the aligned video
+    :type: str
+    :param reference: imaging timestamps in seconds from the trigger, or the number of imaging frames
+                      if they are taken to be evenly spaced at `fps`
+    :type: numpy.ndarray or int
+    :param timestamps: behaviour frame timestamps in seconds from the trigger, or the path to the
+                       camera's timestamp CSV; if None the behaviour frames are spread evenly
+                       over the imaging frames
+    :type: None or str or numpy.ndarray
+    :param fps: frame rate of the output video, i.e. the imaging frame rate
+    :type: float
+    :param mode: one of ('nearest', 'previous'), see align_timestamps
+    :type: str
+    :param tolerance: maximum distance to the matched behaviour frame; black frames are written
+                      for imaging frames without a match
+    :type: None or float
+    :param fourcc: four character code of the output codec
+    :type: str
+
+    :return: index of the behaviour frame written for each imaging frame, -1 for black frames
+    :type: numpy.ndarray
+    """
+    if mode not in ("nearest", "previous"):
+        raise AttributeError(
+            "Keyword 'mode' must be one of: ('nearest', 'previous')"
+        )
+    cap = open_video(filename)
+    if not cap.isOpened():
+        raise FileNotFoundError(f"Cannot open {filename}")
+    seekable = isinstance(cap, VideoSession)
+    n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if n_frames <= 0:
+        # The container does not report its length (i.e. raw h264): count the frames, then start over
+        n_frames = 0
+        while cap.grab():
+            n_frames += 1
+        cap.release()
+        cap = open_video(filename)
+    if n_frames == 0:
+        raise ValueError(f"No frames found in {filename}")
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    if numpy.ndim(reference) == 0:
+        n_reference = int(reference)
+        reference = numpy.arange(n_reference) / fps
+    else:
+        reference = numpy.asarray(reference, dtype=numpy.float64)
+        n_reference = reference.shape[0]
+    if isinstance(timestamps, str):
+        timestamps = load_behaviour_timestamps(timestamps)
+    elif timestamps is None:
+        # Spread the behaviour frames evenly over the imaging session
+        timestamps = numpy.linspace(reference[0], reference[-1], n_frames)
+    indices = align_timestamps(reference, timestamps, mode=mode, tolerance=tolerance)
+    indices[indices >= n_frames] = n_frames - 1
+
+    out = cv2.VideoWriter(
+        output, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height)
+    )
+    black = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+    frame, current = black, -1
+    try:
+        for index in indices:
+            if seekable and index > current + 1 and cap.segment(index) != cap.segment(current + 1):
+                # Start of a later segment: skip the segments in between
+                cap.seek(index)
+                current = index - 1
+            while current < index:
+                current += 1
+                if current < index:
+                    ok = cap.grab()
+                else:
+                    ok, frame = cap.read()
+                if not ok:
+                    raise ValueError(
+                        f"{filename} ended after {current} of {n_frames} frames"
+                    )
+            out.write(frame if index >= 0 else black)
+    finally:
+        cap.release()
+        out.release()
+    return indices
 
 
 def downsample(array, new_shape):
@@ -676,6 +1908,441 @@ def global_signal(frames):
     return globalsignal, mean_g, beta_g
 
 
+def seed_correlation(frames, mask, seeds, block_size=None):
+    """
+    Pearson correlation of every pixel in `mask` with the pixels at `seeds`,
+    computed as one product of z-scored traces instead of one numpy.corrcoef per pixel
+
+    :param frames: 3D array of image frames, (frames, height, width)
+    :type: numpy.ndarray
+    :param mask: boolean region of interest, (height, width)
+    :type: numpy.ndarray
+    :param seeds: coordinates of the seed pixels, indexing frames[:, seed[0], seed[1]]
+    :type: list of tuple-like
+    :param block_size: number of pixels correlated at a time to bound memory; all at once if None
+    :type: None or int>0
+
+    :return: correlations, (pixels, seeds), with pixels in the row-major order of numpy.nonzero(mask);
+             nan for pixels or seeds without variance
+    :type: numpy.ndarray
+    """
+    rows, cols = numpy.nonzero(mask)
+    seeds = numpy.asarray(seeds, dtype=numpy.int64).reshape(-1, 2)
+
+    def zscore(traces):
+        traces = traces.astype(numpy.float64)
+        traces -= traces.mean(axis=0)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            traces /= numpy.sqrt(numpy.sum(traces ** 2, axis=0))
+        return traces
+
+    seed_traces = zscore(frames[:, seeds[:, 0], seeds[:, 1]])
+    n_pixels = rows.shape[0]
+    if block_size is None:
+        block_size = max(n_pixels, 1)
+    correlations = numpy.empty((n_pixels, seeds.shape[0]), dtype=numpy.float64)
+    for start in range(0, n_pixels, block_size):
+        block = slice(start, start + block_size)
+        pixel_traces = zscore(frames[:, rows[block], cols[block]])
+        correlations[block] = numpy.matmul(pixel_traces.T, seed_traces)
+    return correlations
+
+
+def polygon_mask(polygon, shape):
+    """
+    Rasterize a polygon into a boolean mask, pixel (x, y) being set if
+    shapely.geometry.Point(x, y).within(polygon) is True.
+    Note the first coordinate indexes the first axis, as in frames[:, x, y];
+    RoiPoly masks from draw_mask are indexed [y, x], i.e. the transpose.
+
+    :param polygon: vertices [(x, y), ...] or a shapely Polygon
+    :type: list or shapely.geometry.Polygon
+    :param shape: shape of the mask, i.e. frames.shape[1:]
+    :type: tuple
+
+    :return: mask of the pixels strictly inside the polygon
+    :type: numpy.ndarray
+    """
+    if hasattr(polygon, "exterior"):
+        polygon = polygon.exterior.coords
+    vertices = numpy.asarray(polygon, dtype=numpy.float64)
+    x, y = numpy.meshgrid(
+        numpy.arange(shape[0]), numpy.arange(shape[1]), indexing="ij"
+    )
+    points = numpy.column_stack((x.ravel(), y.ravel())).astype(numpy.float64)
+    inside = Path(vertices).contains_points(points)
+
+    # Points on the outline are not within the polygon
+    on_outline = numpy.zeros(points.shape[0], dtype=bool)
+    for start, end in zip(vertices, numpy.roll(vertices, -1, axis=0)):
+        edge = end - start
+        length = numpy.dot(edge, edge)
+        if length == 0:
+            continue
+        offset = points - start
+        cross = edge[0] * offset[:, 1] - edge[1] * offset[:, 0]
+        projection = numpy.matmul(offset, edge)
+        on_outline |= (
+            (numpy.abs(cross) < 1e-9) & (projection >= 0) & (projection <= length)
+        )
+    return (inside & ~on_outline).reshape(shape[0], shape[1])
+
+
+def roi_masks(polygons, shape, cache_file=None):
+    """
+    Rasterize the regions of interest of one animal, reusing the masks stored in
+    `cache_file` when they were made from the same polygons and shape
+
+    :param polygons: polygons keyed by name, i.e. {'left': coords_left, 'right': coords_right}
+    :type: dict
+    :param shape: shape of the masks, i.e. frames.shape[1:]
+    :type: tuple
+    :param cache_file: .npz file to load the masks from or save them to
+    :type: None or str
+
+    :return: boolean masks keyed like polygons, see polygon_mask
+    :type: dict
+    """
+    vertices = {
+        name: numpy.asarray(
+            polygon.exterior.coords if hasattr(polygon, "exterior") else polygon,
+            dtype=numpy.float64,
+        )
+        for name, polygon in polygons.items()
+    }
+    if cache_file is not None and os.path.isfile(cache_file):
+        with numpy.load(cache_file) as cached:
+            if all(
+                f"{name}_coords" in cached
+                and name in cached
+                and numpy.array_equal(cached[f"{name}_coords"], coords)
+                and cached[name].shape == tuple(shape[:2])
+                for name, coords in vertices.items()
+            ):
+                return {name: cached[name] for name in vertices}
+
+    masks = {
+        name: polygon_mask(coords, shape) for name, coords in vertices.items()
+    }
+    if cache_file is not None:
+        numpy.savez_compressed(
+            cache_file,
+            **masks,
+            **{f"{name}_coords": coords for name, coords in vertices.items()},
+        )
+    return masks
+
+
+def label_map(x_coord, y_coord, labels, shape):
+    """
+    Assemble a label map from per-pixel labels by direct indexing.
+    Pixels without a label are 0; pixels listed more than once get their mean label.
+
+    :param x_coord: first coordinate of each pixel
+    :type: array-like of int
+    :param y_coord: second coordinate of each pixel
+    :type: array-like of int
+    :param labels: label of each pixel
+    :type: array-like
+    :param shape: shape of the map, i.e. frames.shape[1:]
+    :type: tuple
+
+    :return: label map
+    :type: numpy.ndarray
+    """
+    flat = numpy.ravel_multi_index(
+        (numpy.asarray(x_coord, dtype=numpy.int64), numpy.asarray(y_coord, dtype=numpy.int64)),
+        shape,
+    )
+    size = shape[0] * shape[1]
+    sums = numpy.bincount(flat, weights=labels, minlength=size)
+    counts = numpy.bincount(flat, minlength=size)
+    graph_matrix = numpy.zeros(size)
+    numpy.divide(sums, counts, out=graph_matrix, where=counts > 0)
+    return graph_matrix.reshape(shape)
+
+
+def region_trace(frames, mask):
+    """
+    Mean of the pixels in `mask` for every frame, as one matrix-vector product
+
+    :param frames: 3D array of image frames, (frames, height, width)
+    :type: numpy.ndarray
+    :param mask: boolean region, (height, width)
+    :type: numpy.ndarray
+
+    :return: region mean trace, (frames,)
+    :type: numpy.ndarray
+    """
+    weights = numpy.ravel(mask).astype(numpy.float64)
+    weights /= weights.sum()
+    return numpy.matmul(frames.reshape(frames.shape[0], -1), weights)
+
+
+def sliding_correlation(a, b, window, pad=False):
+    """
+    Pearson correlation between traces a and b over every window of `window` frames,
+    from cumulative sums in O(T) instead of one numpy.corrcoef per window.
+    a and b are broadcast against each other, so batches of region pairs and mouse pairs
+    can be computed at once, i.e. sliding_correlation(traces[:, None], traces[None, :], window)
+    for all pairs of the rows of traces.
+
+    :param a: traces, (..., frames)
+    :type: numpy.ndarray
+    :param b: traces, (..., frames)
+    :type: numpy.ndarray
+    :param window: number of frames per window
+    :type: int>1
+    :param pad: if True, pad with nans to the length of the traces so that each value sits
+                at the centre of its window
+    :type: bool
+
+    :return: correlations, (..., frames - window + 1), or (..., frames) if pad is True;
+             nan for windows without variance
+    :type: numpy.ndarray
+    """
+    a, b = numpy.broadcast_arrays(
+        numpy.asarray(a, dtype=numpy.float64), numpy.asarray(b, dtype=numpy.float64)
+    )
+    n_frames = a.shape[-1]
+    if not 1 < window <= n_frames:
+        raise ValueError(
+            f"Argument `window` should be between 2 and {n_frames}, {window} given instead"
+        )
+    # Centring first keeps the differences of the cumulative sums well conditioned
+    a = a - a.mean(axis=-1, keepdims=True)
+    b = b - b.mean(axis=-1, keepdims=True)
+
+    def window_sums(x):
+        cumulative = numpy.cumsum(x, axis=-1)
+        sums = cumulative[..., window - 1 :].copy()
+        sums[..., 1:] -= cumulative[..., :-window]
+        return sums
+
+    sum_a, sum_b = window_sums(a), window_sums(b)
+    covariance = window_sums(a * b) - sum_a * sum_b / window
+    variance_a = window_sums(a * a) - sum_a ** 2 / window
+    variance_b = window_sums(b * b) - sum_b ** 2 / window
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        correlation = covariance / numpy.sqrt(variance_a * variance_b)
+    correlation = numpy.clip(correlation, -1, 1)
+
+    if pad:
+        padding = [(0, 0)] * (correlation.ndim - 1) + [
+            (window // 2, window - window // 2 - 1)
+        ]
+        correlation = numpy.pad(correlation, padding, constant_values=numpy.nan)
+    return correlation
+
+
+def region_traces(frames, labels, masks=None, block_size=1024):
+    """
+    Mean trace of every labelled region in one pass over the frames, as the product of
+    the reshaped (frames, pixels) stack with a (pixels, regions) averaging matrix
+
+    :param frames: 3D array of image frames, (frames, height, width)
+    :type: numpy.ndarray
+    :param labels: label map, i.e. graph_matrix from clustering; 0 is background
+    :type: numpy.ndarray
+    :param masks: boolean masks splitting the label map into groups, i.e. the hemispheres
+                  from roi_masks, so that the same label on either side gives two regions
+    :type: None or dict
+    :param block_size: number of frames reduced at a time
+    :type: int>0
+
+    :return: mean trace of each region keyed by label, or by (mask name, label) if masks is given;
+             empty if labels has no nonzero label
+    :type: dict
+    """
+    labels = numpy.asarray(labels)
+    groups = {None: numpy.ones(labels.shape, dtype=bool)} if masks is None else masks
+    regions, weights = [], []
+    for name, group in groups.items():
+        for label in numpy.unique(labels[group]):
+            if label == 0:
+                continue
+            region = group & (labels == label)
+            regions.append(label.item() if masks is None else (name, label.item()))
+            weights.append(numpy.ravel(region) / numpy.count_nonzero(region))
+    if not regions:
+        # No labelled pixels: no traces
+        return {}
+    weights = numpy.array(weights, dtype=numpy.float64).reshape(len(regions), -1).T
+
+    n_frames = frames.shape[0]
+    pixels = frames.reshape(n_frames, -1)
+    traces = numpy.empty((len(regions), n_frames), dtype=numpy.float64)
+    for start in range(0, n_frames, block_size):
+        stop = min(start + block_size, n_frames)
+        traces[:, start:stop] = numpy.matmul(pixels[start:stop], weights).T
+    return dict(zip(regions, traces))
+
+
+def window_correlation(a, b, windows):
+    """
+    Pearson correlation between traces a and b within each of the given windows,
+    from cumulative sums. a and b are broadcast against each other as in sliding_correlation.
+
+    :param a: traces, (..., frames)
+    :type: numpy.ndarray
+    :param b: traces, (..., frames)
+    :type: numpy.ndarray
+    :param windows: (start, stop) frame of each window, i.e. interaction_window
+    :type: list of tuple
+
+    :return: correlations, (..., windows); nan for windows without variance
+    :type: numpy.ndarray
+    """
+    a, b = numpy.broadcast_arrays(
+        numpy.asarray(a, dtype=numpy.float64), numpy.asarray(b, dtype=numpy.float64)
+    )
+    a = a - a.mean(axis=-1, keepdims=True)
+    b = b - b.mean(axis=-1, keepdims=True)
+    windows = numpy.asarray(windows, dtype=numpy.int64).reshape(-1, 2)
+    start, stop = windows[:, 0], windows[:, 1]
+    length = stop - start
+
+    def window_sums(x):
+        cumulative = numpy.zeros(x.shape[:-1] + (x.shape[-1] + 1,))
+        numpy.cumsum(x, axis=-1, out=cumulative[..., 1:])
+        return cumulative[..., stop] - cumulative[..., start]
+
+    sum_a, sum_b = window_sums(a), window_sums(b)
+    covariance = window_sums(a * b) - sum_a * sum_b / length
+    variance_a = window_sums(a * a) - sum_a ** 2 / length
+    variance_b = window_sums(b * b) - sum_b ** 2 / length
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return numpy.clip(covariance / numpy.sqrt(variance_a * variance_b), -1, 1)
+
+
+def rasterize_cursor_plot(fig, ax, x_values, dpi=None):
+    """
+    Draw a static figure once and find where a vertical cursor at each of x_values falls on it
+
+    :param fig: figure to rasterize
+    :type: matplotlib.figure.Figure
+    :param ax: axes the cursor moves along
+    :type: matplotlib.axes.Axes
+    :param x_values: data x-coordinate of the cursor in each video frame
+    :type: array-like
+    :param dpi: resolution to draw the figure at; the figure's own if None
+    :type: None or float
+
+    :return: BGR image of the figure; pixel column of the cursor in each frame;
+             first and last pixel row spanned by the axes
+    :type: tuple of (numpy.ndarray, numpy.ndarray, tuple)
+    """
+    if dpi is not None:
+        fig.set_dpi(dpi)
+    fig.canvas.draw()
+    rgba = numpy.asarray(fig.canvas.buffer_rgba())
+    background = cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGR)
+    height, width, _ = background.shape
+
+    x_values = numpy.asarray(x_values, dtype=numpy.float64)
+    display = ax.transData.transform(
+        numpy.column_stack((x_values, numpy.zeros_like(x_values)))
+    )
+    columns = numpy.clip(numpy.round(display[:, 0]).astype(numpy.int64), 0, width - 1)
+    bbox = ax.get_window_extent()
+    rows = (
+        max(int(round(height - bbox.y1)), 0),
+        min(int(round(height - bbox.y0)), height),
+    )
+    return background, columns, rows
+
+
+def write_cursor_video(
+    background, columns, filename, fps=30, rows=None, color=(0, 0, 0), line_width=2, fourcc="mp4v"
+):
+    """
+    Encode a video of a static background with a moving vertical cursor, compositing only
+    the cursor into each frame and streaming the frames to cv2.VideoWriter
+
+    :param background: BGR image, i.e. from rasterize_cursor_plot
+    :type: numpy.ndarray
+    :param columns: pixel column of the cursor in each frame
+    :type: array-like of int
+    :param filename: path to the video file
+    :type: str
+    :param fps: frame rate of the video
+    :type: float
+    :param rows: first and last pixel row of the cursor; the full height if None
+    :type: None or tuple
+    :param color: BGR color of the cursor
+    :type: tuple
+    :param line_width: width of the cursor in pixels
+    :type: int>0
+    :param fourcc: four character code of the codec
+    :type: str
+
+    :return: filename
+    :type: str
+    """
+    frame = numpy.array(background, dtype=numpy.uint8, order="C")
+    height, width, _ = frame.shape
+    top, bottom = (0, height) if rows is None else rows
+    out = cv2.VideoWriter(
+        filename, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height)
+    )
+    try:
+        for column in columns:
+            left = max(int(column) - line_width // 2, 0)
+            right = min(left + line_width, width)
+            saved = frame[top:bottom, left:right].copy()
+            frame[top:bottom, left:right] = color
+            out.write(frame)
+            frame[top:bottom, left:right] = saved
+    finally:
+        out.release()
+    return filename
+
+
+def render_cursor_video(fig, ax, x_values, filename, fps=30, dpi=None, **kwargs):
+    """
+    Render a figure with a vertical cursor moving through x_values to a video, drawing the
+    figure only once. Keyword arguments are passed to write_cursor_video.
+
+    :param fig: figure to render
+    :type: matplotlib.figure.Figure
+    :param ax: axes the cursor moves along
+    :type: matplotlib.axes.Axes
+    :param x_values: data x-coordinate of the cursor in each video frame
+    :type: array-like
+    :param filename: path to the video file
+    :type: str
+    :param fps: frame rate of the video
+    :type: float
+    :param dpi: resolution to draw the figure at; the figure's own if None
+    :type: None or float
+
+    :return: filename
+    :type: str
+    """
+    background, columns, rows = rasterize_cursor_plot(fig, ax, x_values, dpi)
+    return write_cursor_video(background, columns, filename, fps, rows=rows, **kwargs)
+
+
+def render_cursor_videos(jobs, n_jobs=None):
+    """
+    Encode several cursor videos in parallel worker processes
+
+    :param jobs: keyword arguments of write_cursor_video for each video,
+                 i.e. built from rasterize_cursor_plot for each region
+    :type: list of dict
+    :param n_jobs: number of workers to utilise for parallel jobs
+    :type: None or int>0
+
+    :return: filenames of the videos
+    :type: list
+    """
+    if n_jobs is None:
+        n_jobs = min(cpu_count(), max(len(jobs), 1))
+    return Parallel(n_jobs=n_jobs, verbose=0)(
+        delayed(write_cursor_video)(**job) for job in jobs
+    )
+
+
 def draw_mask(frame):
     plt.imshow(frame, cmap='gray', vmin=0, vmax=200)
     mask_left = RoiPoly(color='r')